@@ -1,12 +1,33 @@
 """Investigative Script on the game of Chomp"""
 import csv
+import json
+import os
 import pickle
-from copy import deepcopy
+import shutil
+import struct
+import threading
+import zlib
+from collections import Counter
+from contextlib import ExitStack, nullcontext
+from functools import cached_property
+from math import comb
+from time import perf_counter
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.collections import PatchCollection
+from matplotlib.figure import Figure
+from matplotlib.patches import Rectangle
 import tkinter as tk
 from tkinter.filedialog import askopenfilename
 
+# where the tables for each size of bar are kept between runs
+defaultCacheDir = os.environ.get(
+    'CHOMP_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'chomp'))
+tableVersion = 1  # change whenever the layout of a cached table changes
+modelVersion = 1  # version of the model directories written by Bar.save
+opponents = ['human', 'random', 'intelligent', 'perfect']  # GameLog codes
+unlocked = nullcontext()  # held in place of a lock when there are none
+
 
 class Bar(object):
     """ A bar of chocolate is the playing surface for the game of chomp.
@@ -16,10 +37,17 @@ class Bar(object):
 
     Data Structures:
         The internal data structure used to represent the Bar is a
-        rectangular numpy array. Squares are numbered from zero in
-        reading-order (left to right then down). In the self.eaten array,
-        a zero indicates a square is not yet eaten, and other numbers
-        indicate the player who ate the square.
+        bitboard - a Python int, self.board, where bit n is set once square
+        n has been eaten. Squares are numbered from zero in reading-order
+        (left to right then down). self.quadrants[n] has the bits set for
+        square n and every square below and to the right of it, so a bite
+        is a single OR and a square is free to eat if ANDing it with the
+        board gives zero. self.playerBoards holds a bitboard of the squares
+        each player has eaten.
+
+        self.eaten is built from these bitboards when it is asked for, as a
+        rectangular numpy array. A zero indicates a square is not yet
+        eaten, and other numbers indicate the player who ate the square.
 
         Finitely many game states exist. These are represented in two
         different ways - a 'description', which is a 1D array containing
@@ -31,21 +59,62 @@ class Bar(object):
         available to eat.
 
         The probability of eating to a particular square is governed by
-        'boxes' representing each potential board state.
+        'boxes' representing each potential board state. The beads are held
+        in self.boxStore, a BeadStore which keeps one row of bead counts per
+        box and only creates a box the first time its state is visited, so
+        memory grows with the states actually reached. self.legal marks
+        which moves are legal from each state. self.boxes gives a Box view
+        onto each state's beads, and self.originalBoxes gives views onto
+        the starting contents, which are worked out when they are needed.
+
+        The tables describing the states of a bar - self.allStates,
+        self.nextState and self.legal - are only built the first time they
+        are used. They are saved as .npy files in a directory for each size
+        of bar under cacheDir, so later runs (and every process in a pool)
+        memory-map them instead of building them again. Pass cacheDir=None
+        to keep them in memory only.
+
+        Transitions between states are held in self.nextState, an array
+        with one row per state and one column per square. Each entry is the
+        state reached by eating that square, or -1 if the move is illegal.
+
+        The current state number and description are cached in
+        self.currentState and self.currentDesc, and are kept up to date by
+        eat(), resetEaten() and setState(). Set self.debug to True to check
+        the cache against recogniseState() after every bite - and the state
+        of each Game against its bitboard after every move.
+
+        If self.journal holds a Journal, every game played is recorded in
+        it, so training can be resumed after a crash. If self.gameLog holds
+        a GameLog, the states and moves of every game are written to it,
+        and replay() can rebuild the boxes from them. If self.stats holds
+        a PlayStats, play() times each phase of a game and counts what
+        happened. Nothing is timed or counted while it is None.
 
     Methods:
         resetEaten() : Resets array of eaten squares
         enumerateStates() : Creates a list of possible board states
+        enumerateDescriptions([start, stop]) : Creates a compact array of
+                                               state descriptions
+        iterateStates([form]) : Yields the states one at a time, as
+                                descriptions or bitboards
         convertDescriptionToBoolean(desc) : Converts a shorthand
                                             description to a boolean
                                             representation
         convertBooleanToDescription(boolRep) : Converts from boolean
                                                representation to shorthand
                                                description
+        produceRankTable() : Generates the table used to rank descriptions
+        descriptionToStateNumber(desc) : Converts a description (or an
+                                         array of them) to a state number
+        stateNumberToDescription(n) : Converts a state number (or an array
+                                      of them) back to a description
         getallStatesFromCSV() : DEPRECATED - receive all states of 3x4
                                 bar from a CSV file
         recogniseState() : Find the index of self.allStates which
                               corresponds with the current bar state
+        checkState() : Compares the cached state number against a full
+                       recompute from self.eaten
         show() : Prints a graphical bar with numbered cells to the screen.
         showUnicode() : Prints a graphical bar using unicode boxes.
         showEaten(): Prints a representation of which parts
@@ -55,23 +124,77 @@ class Bar(object):
                          graphics enhancements)
         positionNumberToCoords(n) : Returns the coordinates (row, col) from
                                     square number n.
-        pickRandomAvailableSquareToEat() : Returns the number of an available
-                                           square to eat.
-        getBoxes() : Generate a list of Box objects for the bar
+        produceQuadrantMasks() : Generates the bitboard eaten by each bite
+        booleanToBitboard(boolRep) : Converts a boolean representation to a
+                                     bitboard
+        bitboardToBoolean(board) : Converts a bitboard to a boolean
+                                   representation
+        biteDescription(desc, state, n) : Cuts down a description for a bite
+                                          and returns the new state number
+        availableSquares([board]) : Lists the squares which can be eaten
+        pickRandomAvailableSquareToEat([board]) : Returns the number of an
+                                                  available square to eat.
+        distribution(desc) : Number of beads to start with in the box for
+                             each description
+        legalMoves(states) : Marks the legal moves from some states
+        startingBeads(states) : Starting bead counts for some states' boxes
+        produceBeadTree(beads) : Generates Fenwick trees over the bead counts
+        refreshBeadTree() : Rebuilds the Fenwick trees in self.boxStore
+        lockBoxes(states) : Holds the locks in self.beadLocks for some boxes
+        boxLock(state) : The lock in self.beadLocks for one box
+        shareBetweenThreads([stripes]) : Makes the boxes safe to share
+                                         between threads
+        getBoxes([store]) : Returns a list of Box views onto a BeadStore
+        resetBoxes() : Puts the starting beads back into every box
+        memoryReport() : Prints how many boxes have been created
         record() : Print the number of games won and played and return the
                    percentage.
-        save(filename) : Saves the current box array to a file 'filename'
-        load(filename) : Loads a box array from the file 'filename'
+        save(filename) : Saves the boxes to a model directory 'filename'
+        load(filename) : Loads the boxes from a model directory or an older
+                         pickle file 'filename'
+        loadPickle(filename) : Loads the boxes from an older pickle file
         showBoxChoices() : graphically show the chance of choosing a
                            particular move based on the current state
+        boxBeads(states) : The beads in the boxes of some states, without
+                           creating any boxes
+        boxChoices(states) : The chance of choosing each move from some
+                             states, as an array of grids
+        produceChoiceMosaic(choices) : Tiles grids of choices into one image
+        drawBoxChoices(figure, states, title) : Draws the choices of some
+                                                boxes onto a figure
+        saveBoxChoices(filename, [states, perPage, title]) : Draws the
+                           chances of choosing each move into PNG files,
+                           without needing a display
         setState(n): Sets the bar into a defined state with number n
         printListNextState(): Prints to the screen a list of state transitions
         moveNumberToColour(): Produces a dictionary which maps from move number
                               to the colour of the beads.
+        loadTable(name, produce): Loads a table from the cache, or builds
+                                  and caches it
+        produceTransitionTable(): Generates the array of state transitions
         produceListNextState(): Generates the list of state transitions
         produceLoadSheet(): Print to the screen what to place into each box
-        play(opponent, [display]) : Play chomp.
-                                    opponent = 'human'|'random'|'intelligent'
+        play(opponent, [display]) : Play chomp, driving a Game.
+                                    opponent = 'human'|'random'|
+                                               'intelligent'|'perfect'
+        drawBatch(states) : Draws a bead from the box of each of some states
+        sampleRows(weights, [rng]) : Picks a column from each row in
+                                     proportion to its weight
+        actBatch(states, [mode, rng]) : The machine's moves, or their
+                                        chances, from many states at once
+                                        without taking out any beads
+        playBatch(opponent, nGames, [whofirst]) : Play many games of chomp
+                                                  at once in lockstep.
+                                    opponent = 'random'|'intelligent'|
+                                               'perfect'
+        solve() : Works out which states are won or lost with perfect play
+        winningMoves([state]) : Returns every winning move from a state
+        optimalMoves([state]) : Returns the moves perfect play could make
+        train(nGames, opponent, [seed, evalEvery, callback, timeBudget,
+              batch, progressEvery]) : Trains against an opponent, returning
+                                       the learning curve
+        replay(filename, [games, bounty]) : Rebuilds the boxes from the games
+                                            in a GameLog file
 
 
     Example: Generate a 3x4 bar, Let Players 1 and 2 eat a bit, then show the
@@ -85,11 +208,12 @@ class Bar(object):
             | 8| 9|10|11|
 
         In: bar.eat(n=3, player=1)
-        Out: array([[0, 0, 0, 1],
-                    [0, 0, 0, 1],
-                    [0, 0, 0, 1]])
+        Out: 2184
 
         In: bar.eat(9, 2)
+        Out: 3720
+
+        In: bar.eaten
         Out: array([[0, 0, 0, 1],
                     [0, 0, 0, 1],
                     [0, 2, 2, 1]])
@@ -106,22 +230,103 @@ class Bar(object):
         Out: array([3, 2, 2, 0])
 
     """
-    def __init__(self, rows=3, cols=4, bounty=3, maxBeads=3, minBeads=1):
+    def __init__(self, rows=3, cols=4, bounty=3, maxBeads=3, minBeads=1,
+                 debug=False, cacheDir=defaultCacheDir):
         self.rows = rows
         self.cols = cols
-        self.eaten = np.zeros([rows, cols], dtype=int)
-        self.allStates = self.enumerateStates()
+        self.bounty = bounty
+        self.maxBeads = maxBeads
+        self.minBeads = minBeads
+        self.debug = debug  # check the cached state after every bite
+        self.cacheDir = cacheDir
+        self.beadLocks = None  # locks shared between processes, if any
+        self.recordLock = None  # guards the game records between threads
+        self.rankTable = self.produceRankTable()
+        self.nStates = comb(rows+cols, cols)
+        self.quadrants = self.produceQuadrantMasks()
+        self.resetEaten()
         self.finished = False  # game over if this is True
-        self.boxes = self.getBoxes(bounty, maxBeads, minBeads)
-        self.originalBoxes = deepcopy(self.boxes)
+        self.boxStore = BeadStore(self)
+        self.boxes = self.getBoxes(self.boxStore)
         self.gamesPlayed = 0
         self.gamesWon = 0
-        self.nextStateList = self.produceListNextState()
         self.lookup = self.moveNumberToColour()
+        self.winning = None  # filled in by solve()
+        self.journal = None  # a Journal recording training, if any
+        self.gameLog = None  # a GameLog recording every game, if any
+        self.stats = None  # a PlayStats profiling play(), if any
+
+    def __getstate__(self):
+        """Leaves out the open files and locks when the bar is pickled, as
+        it is for a worker process started by spawn"""
+        state = self.__dict__.copy()
+        for name in ['journal', 'gameLog', 'beadLocks', 'recordLock']:
+            state[name] = None
+        return state
+
+    @cached_property
+    def allStates(self):
+        """Boolean representation of every state, built when first used"""
+        return self.loadTable('allStates', self.enumerateStates)
+
+    @cached_property
+    def nextState(self):
+        """Transition table of every state, built when first used"""
+        return self.loadTable('nextState', self.produceTransitionTable)
+
+    @cached_property
+    def legal(self):
+        """Legal moves from every state, built when first used"""
+        return self.loadTable('legal', lambda: self.nextState >= 0)
+
+    @cached_property
+    def nextStateList(self):
+        """List of state transitions, built when first used"""
+        return self.produceListNextState()
+
+    def loadTable(self, name, produce):
+        """Returns the table called name for this size of bar, memory-mapped
+        read-only from the cache directory. If it isn't there yet it is
+        built by calling produce() and saved for next time.
+        """
+        if self.cacheDir is None:
+            return produce()
+        folder = os.path.join(self.cacheDir, 'v{}'.format(tableVersion),
+                              '{}x{}'.format(self.rows, self.cols))
+        path = os.path.join(folder, name + '.npy')
+        if not os.path.exists(path):
+            table = produce()
+            os.makedirs(folder, exist_ok=True)
+            # write then rename, so other processes never see half a file
+            temporary = '{}.{}.tmp.npy'.format(path[:-4], os.getpid())
+            np.save(temporary, table)
+            os.replace(temporary, path)
+        return np.load(path, mmap_mode='r')
+
+    @property
+    def eaten(self):
+        """Returns a (rows, cols) array which is zero for squares not yet
+        eaten, and otherwise holds the player who ate the square"""
+        eaten = np.zeros(self.rows*self.cols, dtype=int)
+        for player, board in self.playerBoards.items():
+            eaten[self.bitboardToBoolean(board)] = player
+        return eaten.reshape(self.rows, self.cols)
+
+    @eaten.setter
+    def eaten(self, eaten):
+        eaten = np.ravel(eaten)
+        self.board = self.booleanToBitboard(eaten != 0)
+        self.playerBoards = {}
+        for player in np.unique(eaten[eaten != 0]).tolist():
+            self.playerBoards[player] = self.booleanToBitboard(
+                eaten == player)
 
     def resetEaten(self):
         """Resets the self.eaten array to all zeros"""
-        self.eaten = np.zeros([self.rows, self.cols], dtype=int)
+        self.board = 0
+        self.playerBoards = {}
+        self.currentDesc = np.full(self.cols, self.rows, dtype=int)
+        self.currentState = self.descriptionToStateNumber(self.currentDesc)
 
     def enumerateStates(self):
         """ Enumerates all possible bar states
@@ -139,63 +344,124 @@ class Bar(object):
 
         Returns the list of possible bars in a boolean representation
         """
+        return self.convertDescriptionToBoolean(self.enumerateDescriptions())
+
+    def enumerateDescriptions(self, start=0, stop=None, chunk=2**20):
+        """Returns a compact uint8 array of shape (states, cols) holding the
+        descriptions of states start to stop-1 (by default all of them)
+
+        The descriptions are unranked a chunk of states at a time, so the
+        working memory stays small however many states are asked for.
+        """
+        if stop is None:
+            stop = self.nStates
+        descs = np.empty([max(stop-start, 0), self.cols], dtype=np.uint8)
+        for first in range(start, stop, chunk):
+            last = min(first+chunk, stop)
+            descs[first-start:last-start] = self.stateNumberToDescription(
+                np.arange(first, last))
+        return descs
+
+    def iterateStates(self, form='description'):
+        """Yields every bar state in the order of self.allStates, one at a
+        time, without building them all first. This works for bars far too
+        large for the whole list to fit in memory.
+
+        form chooses what is yielded for each state:
+            'description' - a list like [3,2,2,0]
+            'bitboard' - an int with bit n set if square n is eaten
+        """
         rows = self.rows
         cols = self.cols
-        fullList = []
-        current = np.zeros([cols, 1], dtype=int)
-        q = deepcopy(current.T)
-        fullList.append(q)
-        check = -1  # index of position to first look at
-        while current[0] <= rows:  # loop until higher number than rows
-            if current[check] == current[check-1]:  # if pair are the same
-                if check-1 != -1*cols:  # and this isn't the last pair
-                    check -= 1  # compare a pair higher
-                else:
-                    current[0] += 1
-                    current[1:] = 0
-                    check = -1
-                    q = deepcopy(current.T)
-                    fullList.append(q)
-            else:  # current pair are not the same
-                if current[check] <= current[check-1]-1:  # rollover condition
-                    current[check] += 1
-                    if check != -1:
-                        current[check+1:] = 0  # set end digits to zero
-                else:  # no rollover of digits
-                    current[check] += 1
-                q = deepcopy(current.T)
-                fullList.append(q)
-                check = -1
-        check = -1
-
-        f = fullList[:-1]  # last element is not valid
-        boolRep = np.zeros([rows*cols, len(f)])  # boolean representation
-        for j, desc in enumerate(f):
-            desc = np.squeeze(desc)
-            for i in range(cols):
-                boolRep[i::cols, j] = np.concatenate(
-                    (np.zeros([desc[i]]), np.ones([rows-desc[i]])))
-        return boolRep.T.astype('bool')
+        if form == 'bitboard':
+            # columnBits[k][d] - eaten squares in column k with d left
+            columnBits = [[sum(1 << (j*cols+k) for j in range(d, rows))
+                           for d in range(rows+1)] for k in range(cols)]
+        elif form != 'description':
+            raise NameError('Unknown form of state')
+        desc = [0]*cols
+        while True:
+            if form == 'bitboard':
+                yield sum(columnBits[k][desc[k]] for k in range(cols))
+            else:
+                yield list(desc)
+            # increment the last column which can still grow,
+            # emptying every column after it
+            k = cols-1
+            while k >= 0 and desc[k] == (desc[k-1] if k > 0 else rows):
+                k -= 1
+            if k < 0:
+                return
+            desc[k] += 1
+            desc[k+1:] = [0]*(cols-k-1)
 
     def convertDescriptionToBoolean(self, desc):
         """Converts a description of a bar, like [3,3,2,0] to a boolean
         representation, [0,0,0,1,0,0,0,1,0,0,1,1]
+
+        desc may also be an array of descriptions with shape (..., cols), in
+        which case an array of shape (..., rows*cols) is returned
         """
-        cols = self.cols
-        rows = self.rows
-        boolRep = np.zeros([rows*cols])  # boolean representation
-        desc = np.squeeze(desc)
-        for i in range(cols):
-            boolRep[i::cols] = np.concatenate(
-                (np.zeros(desc[i]), np.ones([rows-desc[i]])))
-        return boolRep.astype('bool')
+        desc = np.asarray(desc)
+        eaten = np.arange(self.rows)[:, None] >= desc[..., None, :]
+        return eaten.reshape(desc.shape[:-1] + (self.rows*self.cols,))
 
     def convertBooleanToDescription(self, boolRep):
         """Converts a boolean representation like [0,0,0,1,0,0,0,1,0,0,1,1]
         into a description like [3,3,2,0]
+
+        boolRep may also be an array of boolean representations with shape
+        (..., rows*cols), in which case an array of shape (..., cols) is
+        returned
+        """
+        boolRep = np.asarray(boolRep, dtype=bool)
+        if boolRep.shape[-1] == self.rows*self.cols:
+            batchShape = boolRep.shape[:-1]
+        else:  # a single bar in (rows, cols) form
+            batchShape = ()
+        grid = boolRep.reshape(batchShape + (self.rows, self.cols))
+        return np.sum(np.invert(grid), -2)
+
+    def produceRankTable(self):
+        """Returns a (cols, rows+1) table used to rank descriptions
+
+        States are numbered in lexicographic order of their descriptions.
+        rankTable[i, v] is the number of descriptions which agree with a
+        given description before column i, but have fewer than v uneaten
+        squares in column i. A non-increasing tail of length k with at most
+        v squares per column can be chosen in comb(k+v, v) ways, so summing
+        these over the smaller values gives comb(k+v, v-1).
+        """
+        table = np.zeros([self.cols, self.rows+1], dtype=np.int64)
+        for i in range(self.cols):
+            k = self.cols-i-1  # length of the tail after column i
+            for v in range(1, self.rows+1):
+                table[i, v] = comb(k+v, v-1)
+        return table
+
+    def descriptionToStateNumber(self, desc):
+        """Returns the index in self.allStates of a description like
+        [3,2,2,0], or an array of indices for an array of descriptions
+        with shape (..., cols)
         """
-        return np.sum(np.invert(boolRep.reshape(
-            self.rows, self.cols)).astype('int'), 0)
+        desc = np.asarray(desc)
+        ranks = np.sum(self.rankTable[np.arange(self.cols), desc], -1)
+        if ranks.ndim == 0:
+            return int(ranks)
+        return ranks
+
+    def stateNumberToDescription(self, n):
+        """Returns the description of state n, or an array of descriptions
+        with shape (..., cols) for an array of state numbers
+        """
+        remaining = np.array(n, dtype=np.int64)
+        desc = np.zeros(remaining.shape + (self.cols,), dtype=int)
+        for i in range(self.cols):
+            # the largest value which doesn't overshoot the remaining rank
+            v = np.searchsorted(self.rankTable[i], remaining, side='right')-1
+            desc[..., i] = v
+            remaining = remaining - self.rankTable[i, v]
+        return desc
 
     def getallStatesFromCSV(self):
         """Returns a boolean array of bar states -
@@ -213,14 +479,24 @@ class Bar(object):
                     pass
         return barStates.astype('bool')
 
-    def recogniseState(self):
-        """Returns the index of the state which the current bar is in"""
+    def recogniseState(self, eaten=None):
+        """Returns the index of the state which the current bar is in
 
-        boolRepeat = (np.reshape(self.eaten, [1, self.cols*self.rows]) *
-                      np.ones([len(self.allStates), 1])).astype('bool')
-        barPositionID = np.argwhere(np.all
-                                    (self.allStates == boolRepeat, 1))
-        return int(barPositionID)
+        An array of eaten arrays with shape (..., rows, cols) may be passed
+        instead, in which case an array of state numbers is returned
+        """
+        if eaten is None:
+            eaten = self.eaten
+        desc = np.sum(np.asarray(eaten) == 0, -2)
+        return self.descriptionToStateNumber(desc)
+
+    def checkState(self):
+        """Raises an error if the cached state number doesn't match the
+        state recognised from self.eaten"""
+        recognised = self.recogniseState()
+        if recognised != self.currentState:
+            raise RuntimeError('Cached state {} does not match state {}'
+                               .format(self.currentState, recognised))
 
     def show(self):
         """Prints a visual representation of the bar with numbers on squares"""
@@ -235,9 +511,10 @@ class Bar(object):
     def showUnicode(self):
         """Draws a bar on the screen using unicode block elements"""
         print('Current squares which have been eaten')
+        eaten = self.eaten  # built from the bitboards on every access
         for i in range(self.rows):
             for j in range(self.cols):
-                if self.eaten[i, j] == 0:
+                if eaten[i, j] == 0:
                     print('██', end='')
                 else:
                     print('░░', end='')
@@ -247,40 +524,46 @@ class Bar(object):
     def showEaten(self):
         """Prints a representation of which parts of the bar have been eaten"""
         print('Current squares which have been eaten')
+        eaten = self.eaten  # built from the bitboards on every access
         for i in range(self.rows):
             print('|', end='')
             for j in range(self.cols):
-                print('{:2}|'.format(self.eaten[i, j]), end='')
+                print('{:2}|'.format(eaten[i, j]), end='')
             print('')
         print('')
 
     def eat(self, n, player):
-        """"Sets the eaten property of the bar, from some coordinate position
-        specified by n
+        """"Eats square n and every square below and to the right of it,
+        tagging them with player, and returns the new self.board. Eating
+        the poisoned square 0 eats the whole bar, leaving state 0
         """
         # print('Player {} chose to eat square {}'.format(player, n))
-        if n == 0:
-            # print('square 0 is poisoned so Player {} loses'.format(player))
-            self.eaten = np.zeros(self.rows, self.cols)
-        else:
-            topLeftPosition = self.positionNumberToCoords(n)
-            if self.eaten[topLeftPosition] == 0:
-                # now eat that square and all other
-                # nonzero squares to the right and below
-                filt = np.zeros([self.rows, self.cols], dtype=bool)
-                filt[topLeftPosition[0]:, topLeftPosition[1]:] = True
-                squaresAlreadyEatenFilter = self.eaten == 0
-                squaresToEat = np.logical_and(squaresAlreadyEatenFilter, filt)
-                self.eaten[squaresToEat] = player
-            else:
-                pass
-            if len(np.nonzero(self.eaten)) == (self.rows*self.cols)-1:
-                #   print('Player {} wins'.format(player))
-                self.finished = True
-                #  print('After eating, my state is {}'
-                # .format(self.recogniseState()))
-                #  print('\n')
-        return self.eaten
+        if not self.board & (1 << n):  # the square is still there
+            # now eat that square and all other
+            # uneaten squares to the right and below
+            bite = self.quadrants[n]
+            newlyEaten = bite & ~self.board
+            self.board |= bite
+            self.playerBoards[player] = (self.playerBoards.get(player, 0) |
+                                         newlyEaten)
+            self.currentState = self.biteDescription(self.currentDesc,
+                                                     self.currentState, n)
+            if self.debug:
+                self.checkState()
+        return self.board
+
+    def biteDescription(self, desc, state, n):
+        """Cuts down description desc, in place, for a bite at square n, and
+        returns the new state number given the old one, state"""
+        # columns from the bite rightwards are cut down to its row,
+        # which changes their terms in the state number
+        row, col = self.positionNumberToCoords(n)
+        for k in range(col, self.cols):
+            if desc[k] <= row:  # columns never get longer to the right
+                break
+            state += int(self.rankTable[k, row] - self.rankTable[k, desc[k]])
+            desc[k] = row
+        return state
 
     def positionNumberToCoords(self, n):
         """Converts between a position number as reported by self.show()
@@ -290,32 +573,156 @@ class Bar(object):
         colID = n % self.cols
         return (rowID, colID)
 
-    def pickRandomAvailableSquareToEat(self):
+    def produceQuadrantMasks(self):
+        """Returns a list holding, for each square n, a bitboard of square n
+        and every square below and to the right of it"""
+        masks = []
+        for n in range(self.rows*self.cols):
+            row, col = self.positionNumberToCoords(n)
+            quadrant = np.zeros([self.rows, self.cols], dtype=bool)
+            quadrant[row:, col:] = True
+            masks.append(self.booleanToBitboard(quadrant))
+        return masks
+
+    def booleanToBitboard(self, boolRep):
+        """Converts a boolean representation to a bitboard, with bit n set
+        where element n is True"""
+        bits = np.packbits(np.ravel(boolRep).astype(bool), bitorder='little')
+        return int.from_bytes(bits.tobytes(), 'little')
+
+    def bitboardToBoolean(self, board):
+        """Converts a bitboard to a boolean representation"""
+        size = self.rows*self.cols
+        bits = np.frombuffer(board.to_bytes((size+7)//8, 'little'),
+                             dtype=np.uint8)
+        return np.unpackbits(bits, count=size, bitorder='little').astype(bool)
+
+    def availableSquares(self, board=None):
+        """Returns a list of the squares which can still be eaten from a
+        bitboard (by default self.board), leaving out the poisoned square"""
+        if board is None:
+            board = self.board
+        board |= 1  # the poisoned square 0 is never available
+        return [n for n in range(self.rows*self.cols) if not board >> n & 1]
+
+    def pickRandomAvailableSquareToEat(self, board=None):
         """Gets all available squares and chooses one at random
         choosing a square eats from the lower right corner up to and
-        including that square
+        including that square. board is a bitboard to choose from instead
+        of self.board
         """
-        allMoves = np.arange(0, self.rows*self.cols)
-        barID = self.recogniseState()
-        availableMoves = allMoves[np.invert(self.allStates[barID, :])]
-        availableMoves = availableMoves[availableMoves != 0]
-        # remove the chance of zeroing
+        availableMoves = self.availableSquares(board)
         if len(availableMoves) == 0:
             move = -1  # resign
         else:
             move = int(np.random.choice(availableMoves, 1))
         return move
 
-    def getBoxes(self, bounty, maxBeads, minBeads):
+    def distribution(self, desc):
+        """Returns how many beads each move starts with in the box for
+        description desc, or an array of these for an array of descriptions
+
+        This is governed by the sum of the description (how many squares are
+        left over and maxBeads and minBeads)
+        """
+        maxSum = self.rows * self.cols
+        totalSquaresLeft = np.sum(desc, -1)
+        return np.round(np.interp(
+            totalSquaresLeft, [0, maxSum],
+            [self.minBeads, self.maxBeads])).astype(int)
+
+    def legalMoves(self, states):
+        """Returns a boolean array of shape (..., rows*cols) marking the legal
+        moves from each of an array of states, worked out from their
+        descriptions"""
+        descs = self.stateNumberToDescription(states)
+        legal = np.invert(self.convertDescriptionToBoolean(descs))
+        legal[..., 0] = False  # the poisoned square
+        return legal
+
+    def startingBeads(self, states):
+        """Returns an array of shape (..., rows*cols) holding the starting
+        number of beads for each move in the boxes of an array of states"""
+        descs = self.stateNumberToDescription(states)
+        return np.where(self.legalMoves(states),
+                        self.distribution(descs)[..., None], 0)
+
+    def produceBeadTree(self, beads):
+        """Returns an array of shape (states, rows*cols+1) holding a Fenwick
+        tree over each row of beads. Entry i of a row (counting from 1) is
+        the total of the bead counts for moves i-(i&-i) to i-1.
+        """
+        prefix = np.zeros([len(beads), beads.shape[1]+1], dtype=beads.dtype)
+        np.cumsum(beads, 1, out=prefix[:, 1:])
+        i = np.arange(1, beads.shape[1]+1)
+        tree = np.zeros_like(prefix)
+        tree[:, 1:] = prefix[:, i] - prefix[:, i - (i & -i)]
+        return tree
+
+    def lockBoxes(self, states):
+        """Returns a context manager holding the locks for the boxes of
+        states. self.beadLocks is a list of locks, and state n uses lock
+        n % len(self.beadLocks). Nothing is locked if it is None."""
+        stack = ExitStack()
+        if self.beadLocks is not None:
+            stripes = np.unique(np.asarray(states) % len(self.beadLocks))
+            for stripe in stripes:  # always in order, to avoid deadlock
+                stack.enter_context(self.beadLocks[stripe])
+        return stack
+
+    def boxLock(self, state):
+        """Returns the lock in self.beadLocks for the box of state, or a
+        context manager which does nothing if there are no locks"""
+        if self.beadLocks is None:
+            return unlocked
+        return self.beadLocks[state % len(self.beadLocks)]
+
+    def shareBetweenThreads(self, stripes=64):
+        """Lets several threads draw from and replenish the boxes at once,
+        each playing its own Game.
+
+        Every box is created up front, so the bead arrays are never
+        reallocated under another thread. self.beadLocks gets stripes
+        locks, state n using lock n % stripes, which Box.draw and
+        Box.replenish hold while they change a box. self.recordLock guards
+        the games played and won, the journal and the game log.
+        """
+        self.boxStore.materializeAll()
+        self.beadLocks = [threading.Lock() for _ in range(stripes)]
+        self.recordLock = threading.Lock()
+
+    def refreshBeadTree(self):
+        """Rebuilds the Fenwick trees after the beads in self.boxStore have
+        been changed in bulk"""
+        self.boxStore.refreshTree()
+
+    def getBoxes(self, store=None):
         """Returns a list of Box objects which help select the probability of
-        choosing a square to eat
+        choosing a square to eat, each a view onto the beads in a BeadStore
+        (by default self.boxStore)
         """
-        listOfBoxes = []
-        for boolean in self.allStates:
-            description = self.convertBooleanToDescription(boolean)
-            listOfBoxes.append(Box(description, self.rows, self.cols,
-                                   bounty, maxBeads, minBeads))
-        return listOfBoxes
+        if store is None:
+            store = self.boxStore
+        return BoxList(self, store)
+
+    @property
+    def originalBoxes(self):
+        """Box views onto the starting number of beads in every box, made
+        fresh each time they are asked for"""
+        return self.getBoxes(BeadStore(self))
+
+    def resetBoxes(self):
+        """Puts the starting number of beads back into every box"""
+        self.boxStore.clear()
+
+    def memoryReport(self):
+        """Prints how many of the boxes have been created and the memory they
+        use, and returns the number created"""
+        created = len(self.boxStore)
+        print('{} of {} boxes created ({:.1f} percent), using {:.3g} MB'
+              .format(created, self.nStates, 100*created/self.nStates,
+                      self.boxStore.nbytes/2**20))
+        return created
 
     def record(self):
         """Prints the game-win record and returns the win percentage"""
@@ -330,31 +737,95 @@ class Bar(object):
         return per
 
     def save(self, filename):
-        """Pickles the current array of box objects"""
-        with open(filename, 'wb') as f:
-            pickle.dump(self.boxes, f)
+        """Saves the boxes created so far to a model directory filename.
+
+        The directory holds header.json, recording the format version, the
+        size of the bar, its bounty and bead bounds and the games played
+        and won, with two arrays in .npy files: states.npy, the states of
+        the boxes in increasing order, and beads.npy, a row of bead counts
+        for each. These can be memory-mapped - see loadModel().
+        """
+        store = self.boxStore
+        os.makedirs(filename, exist_ok=True)
+        np.save(os.path.join(filename, 'states.npy'), store.states)
+        np.save(os.path.join(filename, 'beads.npy'),
+                store.beads[store.stateRows])
+        header = {'format': 'chomp-model',
+                  'version': modelVersion,
+                  'rows': self.rows,
+                  'cols': self.cols,
+                  'bounty': self.bounty,
+                  'maxBeads': self.maxBeads,
+                  'minBeads': self.minBeads,
+                  'gamesPlayed': self.gamesPlayed,
+                  'gamesWon': self.gamesWon,
+                  'boxes': len(store)}
+        # the header goes last, so a half-written model can't be loaded
+        with open(os.path.join(filename, 'header.json'), 'w') as f:
+            json.dump(header, f, indent=2)
 
     def load(self, filename):
-        """Retrieves an array of box objects"""
+        """Retrieves the boxes and settings from a model directory written by
+        save(), or a file inside one. Anything else is read as an older
+        pickle file by loadPickle()"""
+        if not isModel(filename):
+            self.loadPickle(filename)
+            return
+        header, states, beads = loadModel(filename)
+        if (header['rows'], header['cols']) != (self.rows, self.cols):
+            raise ValueError('Model is for a {}x{} bar, not {}x{}'.format(
+                header['rows'], header['cols'], self.rows, self.cols))
+        self.bounty = header['bounty']
+        self.maxBeads = header['maxBeads']
+        self.minBeads = header['minBeads']
+        self.gamesPlayed = header['gamesPlayed']
+        self.gamesWon = header['gamesWon']
+        store = self.boxStore
+        store.clear()
+        rows = store.rows(states)
+        store.beads[rows] = beads
+        self.refreshBeadTree()
+
+    def loadPickle(self, filename):
+        """Retrieves the bead counts from an older pickle file, holding a list
+        of Box objects, a list of dictionaries mapping moves to bead counts,
+        an array of beads for every state, or a dictionary of states and
+        their beads. Box objects also carry the bounty and bead bounds they
+        were trained with, which are set on the bar"""
         with open(filename, 'rb') as f:
-            boxData = pickle.load(f)
+            boxData = BoxUnpickler(f).load()
             print('Loaded pickled file of type {}'.format(type(boxData)))
-            self.boxes = boxData
+        store = self.boxStore
+        store.clear()
+        if isinstance(boxData, dict) and set(boxData) == {'states', 'beads'}:
+            rows = store.rows(boxData['states'])
+            store.beads[rows] = boxData['beads']
+        elif isinstance(boxData, np.ndarray) and boxData.shape == (
+                self.nStates, self.rows*self.cols):
+            store.materializeAll()
+            store.beads[:] = boxData
+        elif isinstance(boxData, list) and len(boxData) == self.nStates:
+            if isinstance(boxData[0], LegacyBox):
+                self.bounty = boxData[0].bounty
+                self.maxBeads = boxData[0].maxBeads
+                self.minBeads = boxData[0].minBeads
+            for i, box in enumerate(boxData):
+                moveDict = getattr(box, 'moveDict', box)
+                if not isinstance(moveDict, dict):
+                    raise TypeError('Box {} holds a {}, not a dictionary'
+                                    .format(i, type(moveDict)))
+                row = store.row(i)
+                store.beads[row] = 0
+                for move, count in moveDict.items():
+                    store.beads[row, move] = count
+        else:
+            raise TypeError('{} does not hold boxes for a {}x{} bar'.format(
+                filename, self.rows, self.cols))
+        self.refreshBeadTree()
 
     def showBoxChoices(self):
         """Graphically represents the chance of choosing a particular move
         based on the current state of self.boxes"""
-
-        def dict2Grid(d, rows, cols):
-            grid = np.zeros([rows*cols])
-            for i in range(rows*cols):
-                try:
-                    grid[i] = d.moveDict[i]
-                except KeyError:
-                    grid[i] = np.nan
-            grid = np.reshape(grid, [rows, cols])
-            return grid
-
         # display part
         bx = self.boxes
         for i, box in enumerate(bx):
@@ -362,31 +833,123 @@ class Bar(object):
             print(box)
 
         # plotting part
-        nStates = len(self.allStates)
-        sz = np.ceil(np.sqrt(nStates))
         plt.figure()
-        plt.suptitle('Probability of choosing a square')
-        for i in range(nStates):
-            plt.subplot(sz, sz, i+1)
-            g = dict2Grid(self.boxes[i], self.rows, self.cols)
-            plt.imshow(g/(np.nansum(g)),
-                       cmap='viridis', vmin=0, vmax=1)
-            plt.ylabel('State {}'.format(i))
-            plt.colorbar()
+        self.drawBoxChoices(plt.gcf(), np.arange(self.nStates),
+                            'Probability of choosing a square')
         plt.show()
 
+    def boxBeads(self, states):
+        """Returns an array of shape (..., rows*cols) holding the beads in
+        the boxes of an array of states, without creating any boxes. Boxes
+        which don't exist yet give their starting beads"""
+        states = np.asarray(states)
+        store = self.boxStore
+        if store.complete:
+            return store.beads[states]
+        rows = store.rows(states, allocate=False)
+        created = rows != -1
+        beads = np.empty(states.shape + (self.rows*self.cols,), dtype=int)
+        beads[created] = store.beads[rows[created]]
+        beads[~created] = self.startingBeads(states[~created])
+        return beads
+
+    def boxChoices(self, states):
+        """Returns an array of shape (states, rows, cols) holding the chance
+        of choosing each move from the boxes of an array of states. Illegal
+        moves, and every move from a box with no beads, are NaN"""
+        states = np.asarray(states)
+        beads = self.boxBeads(states).astype(float)
+        beads[~self.legalMoves(states)] = np.nan
+        with np.errstate(invalid='ignore', divide='ignore'):
+            choices = beads/np.nansum(beads, 1, keepdims=True)
+        return choices.reshape(-1, self.rows, self.cols)
+
+    def produceChoiceMosaic(self, choices):
+        """Tiles an array of grids from boxChoices into one image, across
+        as many columns as rows, with a NaN gap between the grids. Returns
+        the image and the number of grids across"""
+        across = int(np.ceil(np.sqrt(len(choices))))
+        down = int(np.ceil(len(choices)/across))
+        tiles = np.full([down*across, self.rows+1, self.cols+1], np.nan)
+        tiles[:len(choices), :-1, :-1] = choices
+        mosaic = tiles.reshape(down, across, self.rows+1, self.cols+1)
+        mosaic = mosaic.transpose(0, 2, 1, 3).reshape(
+            down*(self.rows+1), across*(self.cols+1))
+        return mosaic[:-1, :-1], across
+
+    def drawBoxChoices(self, figure, states, title):
+        """Draws the choices of the boxes of states onto a matplotlib
+        figure as a single image with one colour bar"""
+        mosaic, across = self.produceChoiceMosaic(self.boxChoices(states))
+        axes = figure.add_subplot(1, 1, 1)
+        cmap = plt.get_cmap('viridis').copy()
+        cmap.set_bad('white')  # illegal moves and gaps
+        image = axes.imshow(mosaic, cmap=cmap, vmin=0, vmax=1,
+                            interpolation='nearest')
+        axes.set_axis_off()
+        if len(states) <= 400:  # outline and label the grids if legible
+            corners = [((i % across)*(self.cols+1)-0.5,
+                        (i//across)*(self.rows+1)-0.5)
+                       for i in range(len(states))]
+            axes.add_collection(PatchCollection(
+                [Rectangle(corner, self.cols, self.rows)
+                 for corner in corners],
+                facecolor='none', edgecolor='black', linewidth=0.5,
+                clip_on=False))
+            for (x, y), state in zip(corners, states):
+                axes.text(x, y-0.05, 'State {}'.format(state), fontsize=6,
+                          va='bottom')
+        figure.colorbar(image, ax=axes, fraction=0.03)
+        figure.suptitle(title)
+
+    def saveBoxChoices(self, filename, states=None, perPage=1024,
+                       title='Probability of choosing a square',
+                       cellPixels=12):
+        """Draws the chance of choosing each move from the boxes of states
+        (by default all of them) into PNG files, perPage boxes to a file,
+        and returns the names of the files written.
+
+        Every page is one image with one colour bar, drawn with matplotlib's
+        Agg renderer, so no display is needed. With more than one page,
+        the page number is added to filename, as in 'choices-1.png'.
+        """
+        if states is None:
+            states = np.arange(self.nStates)
+        states = np.asarray(states)
+        pages = max(1, int(np.ceil(len(states)/perPage)))
+        stem, extension = os.path.splitext(filename)
+        written = []
+        for page in range(pages):
+            pageStates = states[page*perPage:(page+1)*perPage]
+            across = int(np.ceil(np.sqrt(len(pageStates))))
+            down = int(np.ceil(len(pageStates)/across))
+            size = np.array([across*(self.cols+1), down*(self.rows+1)])
+            size = np.maximum(size*cellPixels/100 + [1.5, 1], [8, 6])
+            figure = Figure(figsize=size, dpi=100)
+            pageTitle = title
+            if pages > 1:
+                pageTitle += ' (page {} of {})'.format(page+1, pages)
+                name = '{}-{}{}'.format(stem, page+1, extension or '.png')
+            else:
+                name = filename
+            self.drawBoxChoices(figure, pageStates, pageTitle)
+            figure.savefig(name)
+            written.append(name)
+        return written
+
     def setState(self, n):
         """Sets the bar into a defined state n"""
-        boolRep = self.enumerateStates()[n]
-        eatenArray = np.reshape(boolRep, (self.rows, self.cols)).astype('int')
-        self.eaten = eatenArray
+        boolRep = self.convertDescriptionToBoolean(
+            self.stateNumberToDescription(n))
+        self.eaten = boolRep.astype('int')
+        self.currentDesc = self.stateNumberToDescription(n)
+        self.currentState = int(n)
 
     def printListNextState(self):
         """Prints to the screen a list of state transition"""
-        for i in range(len(self.nextStateList)):
-            print('{} {} {}'.format(self.nextStateList[i][0],
-                  self.lookup[self.nextStateList[i][1]],
-                  self.nextStateList[i][2]))
+        for pos, move in np.argwhere(self.nextState >= 0):
+            print('{} {} {}'.format(pos, self.lookup[move],
+                                    self.nextState[pos, move]))
 
     def moveNumberToColour(self):
         """Returns the mapping between move numbers and bead colours
@@ -403,24 +966,28 @@ class Bar(object):
                 10: 'White',
                 11: 'Tan'}
 
+    def produceTransitionTable(self):
+        """Returns an array of shape (states, rows*cols) holding the state
+        reached by eating each square from each state, or -1 where the
+        square is already eaten or poisoned"""
+        descs = self.enumerateDescriptions()
+        # int32 holds every state number for bars up to 16x16
+        dtype = np.int32 if self.nStates < 2**31 else np.int64
+        table = np.full([self.nStates, self.rows*self.cols], -1, dtype=dtype)
+        for move in range(1, self.rows*self.cols):  # square 0 is poisoned
+            row, col = self.positionNumberToCoords(move)
+            legal = descs[:, col] > row
+            newDescs = descs[legal]
+            newDescs[:, col:] = np.minimum(newDescs[:, col:], row)
+            table[legal, move] = self.descriptionToStateNumber(newDescs)
+        return table
+
     def produceListNextState(self):
         """Returns a list of 3-element tuples: (from state, move, to State)
         to help us with picking up boxes"""
-        outList = []
-        # first loop - starting positions
-        for pos in range(1, len(self.boxes)):
-            # pos is the starting position
-            self.setState(pos)
-#            print('Current state is {}'.format(pos))
-#            self.showUnicode()
-            for move in range(1, self.rows*self.cols):
-                self.setState(pos)
-#                print('Trying Move {}'.format(move))
-                self.eat(move, 1)
-                newPos = self.recogniseState()
-                if pos != newPos:
-                    outList.append((pos, move, newPos))
-        return outList
+        pos, move = np.nonzero(self.nextState >= 0)
+        return list(zip(pos.tolist(), move.tolist(),
+                        self.nextState[pos, move].tolist()))
 
     def produceLoadSheet(self):
         """Print to the screen what to place into each box"""
@@ -431,17 +998,80 @@ class Bar(object):
                 print('{}, '.format(self.lookup[key]), end='')
             print(' ')
 
+    def solve(self):
+        """Works out the result of every state with perfect play
+
+        Sets self.winning, which is True for states where the player about
+        to move can force a win, and self.distance, the number of moves
+        left before a player is left with only the poisoned square (and so
+        loses). The winner finishes as quickly as possible and the loser
+        holds out as long as possible. self.optimal marks the moves which
+        achieve this from each state.
+
+        Every bite leaves fewer squares, so states are settled in order of
+        squares remaining, a whole level at a time.
+        """
+        descs = self.enumerateDescriptions()
+        squares = np.sum(descs, 1)
+        order = np.argsort(squares, kind='stable')
+        bounds = np.searchsorted(squares[order],
+                                 np.arange(self.rows*self.cols+2))
+        winning = np.zeros(self.nStates, dtype=bool)
+        distance = np.zeros(self.nStates, dtype=int)
+        longest = self.rows*self.cols + 1  # longer than any game
+        for level in range(self.rows*self.cols+1):
+            states = order[bounds[level]:bounds[level+1]]
+            legal = self.legal[states]
+            after = np.where(legal, self.nextState[states], 0)
+            wins = legal & ~winning[after]  # moves leaving the other player
+            quickest = np.min(np.where(wins, distance[after], longest), 1)
+            slowest = np.max(np.where(legal, distance[after], -1), 1)
+            winning[states] = np.any(wins, 1)
+            distance[states] = np.where(winning[states], quickest, slowest)+1
+        after = np.where(self.legal, self.nextState, 0)
+        self.optimal = self.legal & (distance[after] == distance[:, None]-1)
+        # a winner must also leave the other player in a lost position
+        self.optimal &= ~(winning[:, None] & winning[after])
+        self.winning = winning
+        self.distance = distance
+
+    def winningMoves(self, state=None):
+        """Returns an array of every move from state (by default the current
+        state) which leaves the other player in a lost position"""
+        if self.winning is None:
+            self.solve()
+        if state is None:
+            state = self.currentState
+        after = self.nextState[state]
+        legal = after >= 0
+        return np.flatnonzero(legal & ~self.winning[np.where(legal, after, 0)])
+
+    def optimalMoves(self, state=None):
+        """Returns an array of the moves perfect play could make from state
+        (by default the current state)"""
+        if self.winning is None:
+            self.solve()
+        if state is None:
+            state = self.currentState
+        return np.flatnonzero(self.optimal[state])
+
     def play(self, opponent, display=False):
         """Play the game of Chomp against an opponent
         Generalised - takes argument 'opponent' to face either
             'human'
             'random'
             'intelligent'
+            'perfect'
+
+        This drives a Game through its steps, and leaves the bar showing
+        the final position.
         """
+        game = Game(self, opponent.lower())
 
         def humanMove():
             """Ask the human for input, returns a valid move or -1"""
             loop = True
+            game.toBar()
             self.show()
             self.showEaten()
             while loop:
@@ -451,9 +1081,9 @@ class Bar(object):
                 try:
                     move = int(move)  # convert all good inputs to int from str
                 except ValueError:
-                    move = self.pickRandomAvailableSquareToEat()
+                    move = game.randomMove()
                     print('Machine Randomly chose {}'.format(move))
-                if (move in self.boxes[self.recogniseState()].moveDict.keys()):
+                if move in game.legalMoves():
                     return move
                 elif move == 0:
                     print('It\'s all too much - resigned by eating poison')
@@ -464,37 +1094,38 @@ class Bar(object):
                 else:
                     print('Invalid Input')
 
-        def randomMove():
-            """Select a random move from those available"""
-            move = self.pickRandomAvailableSquareToEat()  # positive int or -1
-            return move
-
-        def drawMove():
-            """Draw a move from the distribution"""
-            move = self.boxes[current].draw()
-            return move
-
-        # initialise constants
-        pcMoveList = []
-        opponentMoveList = []
-        positionList = []
-        self.resetEaten()  # reset which boxes have been eaten
-        self.gamesPlayed += 1
-        self.finished = False
-        winner = -1   # don't know the winner yet
-
         # select opponent
-        if opponent.lower() == 'human':
+        if game.opponent == 'human':
             moveFcn = humanMove
-        elif opponent.lower() == 'random':
-            moveFcn = randomMove
-        elif opponent.lower() == 'intelligent':
-            moveFcn = drawMove
+        elif game.opponent == 'random':
+            moveFcn = game.randomMove
+        elif game.opponent == 'intelligent':
+            moveFcn = game.drawMove
+        elif game.opponent == 'perfect':
+            moveFcn = game.perfectMove
         else:
             raise NameError('Unknown Opponent')
 
+        # with profiling on, time each phase of the game
+        stats = self.stats
+        drawMove = game.drawMove
+        apply = game.apply
+        finish = game.finish
+
+        def recognise():
+            """Returns the number of the current state"""
+            return game.state
+
+        if stats is not None:
+            start = perf_counter()
+            recognise = stats.timed('recognise', recognise)
+            drawMove = stats.timed('draw', drawMove)
+            moveFcn = stats.timed('opponent', moveFcn)
+            apply = stats.timed('eat', apply)
+            finish = stats.timed('reinforce', finish)
+
         # if playing a human, ask if they want to go first
-        if opponent.lower() == 'human':
+        if game.opponent == 'human':
             ask = True
             while ask:
                 whofirst = input('Who plays first? 1 for Chomp, 2 for Human: ')
@@ -510,147 +1141,1177 @@ class Bar(object):
         else:
             whofirst = 1  # otherwise chomp first
 
-        if whofirst == 2:        # human player (opponent) goes first
-            current = self.recogniseState()
-            positionList.append(current)
-            move = moveFcn()
-            if move == -1:  # Opponent resigns
-                self.finished = True
-                winner = 1  # other player wins
-            else:  # Opponent plays
-                self.eat(move, 2)
-                opponentMoveList.append(move)
-
-        while self.finished is False:
-            # PC part
-            current = self.recogniseState()  # get current state
-            positionList.append(current)  # add this to list
-            move = drawMove()
-            if move == -1:  # Computer resigns
-                self.finished = True
-                winner = 2  # other player wins
-                break
-            else:  # Computer plays
-                self.eat(move, 1)
-                pcMoveList.append(move)
-
-            # Opponent part
-            current = self.recogniseState()
-            positionList.append(current)
-            move = moveFcn()
-            if move == -1:  # Opponent resigns
-                self.finished = True
-                winner = 1  # other player wins
-                break
-            else:  # Opponent plays
-                self.eat(move, 2)
-                opponentMoveList.append(move)
+        game.start(whofirst)
+        while not game.finished:
+            recognise()
+            if game.player == 1:  # PC part
+                apply(drawMove())
+            else:  # Opponent part
+                apply(moveFcn())
+        game.toBar()
         if display:
-            print('Position List = {}'.format(positionList))
-            print('PC Moves = {}'.format(pcMoveList))
-            print('Opponent Moves = {}'.format(opponentMoveList))
-        if winner == 1:  # the computer wins
-            if display:
-                print('THE COMPUTER WINS'.format(winner))
-            if whofirst == 1:
-                winPositionList = positionList[::2]
-            else:
-                winPositionList = positionList[1::2]
-            winMoveList = pcMoveList
-            self.gamesWon += 1
-        else:  # the opponent wins
-            if display:
+            print('Position List = {}'.format(game.positionList))
+            print('PC Moves = {}'.format(game.pcMoveList))
+            print('Opponent Moves = {}'.format(game.opponentMoveList))
+            if game.winner == 1:  # the computer wins
+                print('THE COMPUTER WINS')
+            else:  # the opponent wins
                 print('OPPONENT WINS -'
                       'But Chomp learns from its mistakes!')
-            if whofirst == 1:  # if chomp went first
-                winPositionList = positionList[1::2]
-            else:
-                winPositionList = positionList[::2]
-#            winPositionList = []
-            winMoveList = opponentMoveList
-#            winMoveList = []
-        for move, position in zip(winMoveList, winPositionList):
-            if display:
-                print('Boosting move {} in box {}'.format(move, position))
-            self.boxes[position].replenish(move)
+        winner = finish(display)
+        if stats is not None:
+            stats.gameOver(game.positionList, winner, perf_counter()-start)
         return winner
 
+    def sampleRows(self, weights, rng=None):
+        """Picks a column from each row of weights in proportion to its
+        weight, or -1 for rows with no weight. rng is a numpy RandomState
+        or Generator, by default numpy's global one"""
+        rng = np.random if rng is None else rng
+        cumulative = np.cumsum(weights, 1)
+        total = cumulative[:, -1]
+        pick = np.floor(rng.random(len(weights))*total)
+        moves = np.argmax(cumulative > pick[:, None], 1)
+        moves[total == 0] = -1
+        return moves
+
+    def actBatch(self, states, mode='sample', rng=None):
+        """Returns the machine's move from each of an array of states,
+        without taking any beads out or creating any boxes
+        Takes argument 'mode' to choose
+            'sample' - a move drawn in proportion to its beads, like
+                       Box.draw
+            'argmax' - the move with the most beads (the lowest numbered
+                       of any tied)
+            'proba' - an array of shape (..., rows*cols) holding the chance
+                      of each move instead of a move
+        A box with no beads gives -1, to resign, or a row of zeros. rng is
+        a numpy RandomState or Generator for 'sample', by default numpy's
+        global one. Boxes are read without taking self.beadLocks, so
+        another thread's draw may or may not be seen.
+        """
+        states = np.asarray(states)
+        beads = self.boxBeads(states)
+        flat = beads.reshape(-1, self.rows*self.cols)
+        if mode == 'sample':
+            moves = self.sampleRows(flat, rng)
+        elif mode == 'argmax':
+            moves = np.argmax(flat, 1)
+            moves[flat.max(1, initial=0) == 0] = -1
+        elif mode == 'proba':
+            total = beads.sum(-1, keepdims=True)
+            return beads/np.maximum(total, 1)
+        else:
+            raise ValueError("mode must be 'sample', 'argmax' or 'proba'")
+        return moves.reshape(states.shape)
+
+    def drawBatch(self, states):
+        """Draws a bead for each of an array of states from their boxes, as
+        if by Box.draw one after another, and returns the moves, with -1
+        for each draw which found its box empty and refilled it. The Fenwick
+        trees are left for the caller to refresh"""
+        store = self.boxStore
+        rows = store.rows(states)  # may reallocate store.beads
+        beads = store.beads
+        unique, group, counts = np.unique(rows, return_inverse=True,
+                                          return_counts=True)
+        single = counts[group] == 1
+        moves = np.full(len(states), -1)
+        moves[single] = self.sampleRows(beads[rows[single]])
+        drawn = single & (moves != -1)
+        cells = (rows[drawn], moves[drawn])
+        # each row appears once, and another process may have taken the bead
+        beads[cells] = np.maximum(beads[cells]-1, 0)
+        empty = single & (moves == -1)
+        beads[rows[empty]] = self.startingBeads(states[empty])
+
+        def takeBeads(box, n):
+            """Returns how many of n beads drawn from box without
+            replacement hold each move"""
+            taken = np.zeros_like(box)
+            total = box.sum()
+            for move in np.flatnonzero(box):
+                if n == 0:
+                    break
+                taken[move] = np.random.hypergeometric(
+                    box[move], total-box[move], n)
+                n -= taken[move]
+                total -= box[move]
+            return taken
+
+        order = np.argsort(group, kind='stable')
+        ends = np.cumsum(counts)
+        shared = np.flatnonzero(counts > 1)  # several draws from one box
+        starts = self.startingBeads(states[order[ends[shared]-1]])
+        for j, start in zip(shared, starts):
+            games = order[ends[j]-counts[j]:ends[j]]
+            box = beads[unique[j]].copy()
+            if len(games) <= box.sum():
+                taken = takeBeads(box, len(games))
+                box -= taken
+                resigned = 0
+            else:  # empty it, then resign and refill it, and so on
+                left = len(games)-box.sum()
+                # each refill is a resignation and then the starting beads
+                full, part = divmod(left, start.sum()+1)
+                taken = box + full*start
+                box = np.zeros_like(start)
+                resigned = full
+                if part:
+                    partial = takeBeads(start, part-1)
+                    taken += partial
+                    box = start - partial
+                    resigned += 1
+            picked = np.repeat(np.arange(len(box)), taken)
+            picked = np.concatenate([picked, np.full(resigned, -1)])
+            np.random.shuffle(picked)  # the games are interchangeable
+            moves[games] = picked
+            beads[unique[j]] = box
+        return moves
+
+    def playBatch(self, opponent, nGames, whofirst=1):
+        """Play nGames games of Chomp at once against an opponent, returning
+        an array of winners
+        Takes argument 'opponent' to face either
+            'random'
+            'intelligent'
+            'perfect'
+        and whofirst, 1 for Chomp or 2 for the opponent.
+
+        The games advance one ply at a time in lockstep, all drawing from
+        the same boxes. Games drawing from the same box in one ply take
+        its beads without replacement, as if one after another: once the
+        box is empty the next game resigns and the box is refilled, as in
+        Box.draw, and any games left draw from the refilled box. The
+        winning moves are replenished together once every game has
+        finished, so a batch behaves like nGames calls to play() which see
+        each other's draws but not each other's rewards - large batches
+        learn more slowly per game for that reason. Only the entries for
+        the boxes visited are written, holding self.beadLocks if it is
+        set, so several processes can share one fully created BeadStore.
+        """
+        if opponent.lower() == 'random':
+            opponentMoves = self.legal
+        elif opponent.lower() == 'intelligent':
+            opponentMoves = None  # draw from the boxes
+        elif opponent.lower() == 'perfect':
+            if self.winning is None:
+                self.solve()
+            opponentMoves = self.optimal
+        else:
+            raise NameError('Unknown Opponent')
+        if whofirst not in [1, 2]:
+            raise ValueError('whofirst must be 1 or 2')
+
+        store = self.boxStore
+
+        maxPlies = self.rows*self.cols  # every bite eats at least one square
+        states = np.full(nGames, self.nStates-1)  # start from the full bar
+        active = np.ones(nGames, dtype=bool)
+        winner = np.zeros(nGames, dtype=int)
+        plyStates = np.zeros([maxPlies, nGames], dtype=int)
+        plyMoves = np.full([maxPlies, nGames], -1)
+        plyPlayer = np.zeros(maxPlies, dtype=int)
+        visited = np.zeros(self.nStates, dtype=bool)
+        for ply in range(maxPlies):
+            games = np.flatnonzero(active)
+            if len(games) == 0:
+                break
+            player = 1 if (ply + whofirst) % 2 == 1 else 2
+            plyPlayer[ply] = player
+            current = states[games]
+            plyStates[ply, games] = current
+            if player == 1 or opponentMoves is None:  # draw from the boxes
+                visited[current] = True
+                with self.lockBoxes(current):
+                    moves = self.drawBatch(current)
+                drawn = moves != -1
+            else:  # pick uniformly from the opponent's choice of moves
+                moves = self.sampleRows(opponentMoves[current])
+                drawn = moves != -1
+            winner[games[~drawn]] = 3 - player  # resigning loses
+            active[games[~drawn]] = False
+            plyMoves[ply, games[drawn]] = moves[drawn]
+            states[games[drawn]] = self.nextState[current[drawn],
+                                                  moves[drawn]]
+
+        # boost the moves made by the winner of each game
+        boost = (plyPlayer[:, None] == winner[None, :]) & (plyMoves != -1)
+        rows = store.rows(plyStates[boost])
+        with self.lockBoxes(plyStates[boost]):
+            np.add.at(store.beads, (rows, plyMoves[boost]), self.bounty)
+        visited[plyStates[boost]] = True
+        store.refreshTree(store.rows(np.flatnonzero(visited)))
+        self.gamesPlayed += nGames
+        self.gamesWon += int(np.sum(winner == 1))
+        if self.journal is not None:
+            self.journal.gameOver(np.flatnonzero(visited).tolist(), nGames)
+        if self.gameLog is not None:
+            plies = np.sum(plyMoves != -1, 0) + 1  # moves and a resignation
+            played = np.arange(maxPlies)[:, None] < plies[None, :]
+            self.gameLog.append(np.where(played, plyStates, -1).T,
+                                plyMoves.T, whofirst, winner,
+                                opponent.lower())
+        return winner
+
+    def train(self, nGames, opponent, seed=None, evalEvery=100,
+              callback=None, timeBudget=None, batch=1, progressEvery=None):
+        """Plays nGames games against opponent to train the boxes, and
+        returns the learning curve as a structured array
+
+        Every evalEvery games a point is added to the curve, holding the
+        games played so far, the games won, the win rate over all of them
+        and over the last evalEvery games, and the seconds taken. The
+        points are kept in an array made before the first game, and
+        nothing is printed between them. callback, if given, is called
+        with each point as it is made.
+
+        seed seeds numpy's random numbers first. Training stops early once
+        timeBudget seconds have passed - checked after every game, or batch
+        of games - and the curve is cut short, ending with a point for the
+        games played since the one before. With batch above 1, games are
+        played batch at a time with playBatch, so opponent can't be 'human',
+        and each game learns less as the rewards only arrive at the end of
+        a batch. progressEvery is the least number of
+        seconds between progress lines - by default there are none.
+        """
+        if seed is not None:
+            np.random.seed(seed)
+        curve = np.zeros(-(-nGames//evalEvery),
+                         dtype=[('games', np.int64), ('won', np.int64),
+                                ('winRate', float), ('recentWinRate', float),
+                                ('seconds', float)])
+        start = perf_counter()
+        lastProgress = start
+        played = 0
+        won = 0
+        for point in range(len(curve)):
+            target = min(played+evalEvery, nGames)
+            wonBefore, playedBefore = won, played
+            while played < target:
+                if batch > 1:
+                    n = min(batch, target-played)
+                    won += int(np.sum(self.playBatch(opponent, n) == 1))
+                    played += n
+                else:
+                    won += self.play(opponent) == 1
+                    played += 1
+                if (timeBudget is not None and
+                        perf_counter()-start >= timeBudget):
+                    break  # record what has been played so far
+            now = perf_counter()
+            curve[point] = (played, won, won/played,
+                            (won-wonBefore)/(played-playedBefore),
+                            now-start)
+            if callback is not None:
+                callback(curve[point])
+            if (progressEvery is not None and
+                    now-lastProgress >= progressEvery):
+                print('{} of {} games, won {:.1f} percent'.format(
+                    played, nGames, 100*won/played))
+                lastProgress = now
+            if timeBudget is not None and now-start >= timeBudget:
+                return curve[:point+1]
+        return curve
+
+    def replay(self, filename, games=None, bounty=None):
+        """Rebuilds the boxes from the first games games (by default all of
+        them) in the GameLog file filename, without playing them again.
+        With bounty, the boxes are rebuilt as if they had been trained
+        with that bounty, which then becomes self.bounty.
+
+        Each box gets its starting beads, plus the bounty for every time
+        the winner of a game made a move from it, less one bead for every
+        time a move was drawn from it - by Chomp, or by an 'intelligent'
+        opponent. These are added up with np.bincount rather than game by
+        game, and the counts are clipped at zero. This
+        matches playing the games in order unless a box ran out of beads
+        part of the way through.
+        """
+        header, log = loadGames(filename)
+        if (header['rows'], header['cols']) != (self.rows, self.cols):
+            raise ValueError('Games are for a {}x{} bar, not {}x{}'.format(
+                header['rows'], header['cols'], self.rows, self.cols))
+        log = log[:games]
+        if bounty is not None:
+            self.bounty = bounty
+        width = self.rows*self.cols
+        states = log['states']
+        moves = log['moves'].astype(np.int64)
+        ply = np.arange(states.shape[1])
+        chompFirst = (log['whofirst'] == 1)[:, None]
+        player = np.where((ply % 2 == 0) == chompFirst, 1, 2)
+        made = moves >= 0
+        won = made & (player == log['winner'][:, None])
+        drawn = made & ((player == 1) | (log['opponent'][:, None] ==
+                                         opponents.index('intelligent')))
+
+        store = self.boxStore
+        store.clear()
+        touched = np.unique(states[made])
+        rows = store.rows(touched)
+        flat = np.searchsorted(touched, states[made])*width + moves[made]
+        size = len(touched)*width
+        change = (self.bounty*np.bincount(flat[won[made]], minlength=size) -
+                  np.bincount(flat[drawn[made]], minlength=size))
+        store.beads[rows] = np.maximum(
+            store.beads[rows] + change.reshape(-1, width), 0)
+        store.refreshTree(rows)
+        self.gamesPlayed = len(log)
+        self.gamesWon = int(np.sum(log['winner'] == 1))
+
 
 class Box(object):
     '''Each bar has as many boxes as possible game states - possible moves are
     represented as beads, which are drawn from the box.
 
+    The beads are stored in a BeadStore, and a Box is a view onto the row
+    for its state there. The row is created the first time the box is
+    changed. A Fenwick tree over that row lets draw pick a bead in
+    O(log moves) rather than O(beads).
+
     Box methods:
-        init - initialise contents depending on description
+        init - attach to a state's beads in a BeadStore
         repr - prints the dictionary
-        populate - initialise internal dictionary with the right number moves
+        moveDict - dictionary of available moves and their bead counts
+        populate - initialise the row with the right number of beads
         distribution - calculates the number of beads to start in each box
         draw - return a move or -1 for resign
+        takeBead - draw without taking the box's lock
+        addBeads - add beads to a move without taking the box's lock
         replenish - add beads to winning moves
+        updateTree - keep the Fenwick tree in step with a changed count
     '''
 
-    def __init__(self, desc, rows, cols, bounty, maxBeads, minBeads):
-        self.desc = np.squeeze(desc)  # to ensure a single dimensional array
-        self.cols = cols
-        self.rows = rows
-        self.bounty = bounty
-        self.maxBeads = maxBeads
-        self.minBeads = minBeads
-        self.moveDict = {}  # create an empty dictionary to store move/beads
-        self.populate()  # populate this dictionary with moves
+    def __init__(self, bar, state, store=None):
+        self.bar = bar
+        self.state = state
+        if store is None:
+            store = bar.boxStore
+        self.store = store
 
     def __repr__(self):
         return repr(self.moveDict)
 
+    @property
+    def desc(self):
+        return self.bar.stateNumberToDescription(self.state)
+
+    @property
+    def bounty(self):
+        return self.bar.bounty
+
+    @property
+    def moveDict(self):
+        '''Returns a dictionary of the available moves and their bead counts.
+        This is a copy - use draw, replenish and populate to change it'''
+        moves = np.flatnonzero(self.bar.legalMoves(self.state))
+        row = self.store.row(self.state, allocate=False)
+        if row == -1:  # not created yet, so it holds the starting beads
+            counts = np.full(len(moves), self.distribution())
+        else:
+            counts = self.store.beads[row, moves]
+        return dict(zip(moves.tolist(), counts.tolist()))
+
     def populate(self):
-        '''Populates the dictionary of available moves'''
-        desc = np.squeeze(self.desc)
-        boolRep = np.zeros([self.rows*self.cols])  # 1 for eaten, 0 for not
-        for i in range(self.cols):
-            boolRep[i::self.cols] = np.concatenate(
-                (np.zeros([desc[i]]), np.ones([self.rows-desc[i]])))
-        boolRep = (1-boolRep).astype('bool')
-        allMoves = np.arange(self.rows*self.cols)
-        availableMoves = allMoves[boolRep]
-        numberOfBeadsEach = self.distribution()
-        for move in availableMoves:
-            self.moveDict[move] = numberOfBeadsEach
-        try:
-            self.moveDict.pop(0)  # force remove the 0 move which loses
-        except KeyError:  # this occurs when trying to populate the empty bar
-            pass
+        '''Puts the starting number of beads on each available move'''
+        if self.bar.stats is not None:
+            self.bar.stats.refills += 1
+        row = self.store.row(self.state)
+        legal = self.bar.legalMoves(self.state)
+        self.store.beads[row, legal] = self.distribution()
+        self.store.refreshTree([row])
 
     def distribution(self):
         '''Controls how many initial beads get placed in each box,
         depending on how far into the game they are
-
-        This is governed by the sum of the description (how many squares are
-        left over and maxBeads and minBeads)
         '''
-        maxSum = self.rows * self.cols
-        totalSquaresLeft = np.sum(self.desc)
-        return np.round(np.interp(
-            totalSquaresLeft, [0, maxSum],
-            [self.minBeads, self.maxBeads])).astype(int)
+        return self.bar.distribution(self.desc)
 
     def draw(self):
-        '''Draws a move from all possible moves available from this box'''
-        moveList = []
-        for k in self.moveDict:
-            for i in range(self.moveDict[k]):
-                moveList.append(k)  # add the move this many times
-        try:  # choose one from the dictionary
-            selected = int(np.random.choice(moveList, 1))
-            self.moveDict[selected] -= 1  # decrement
-        except ValueError:  # there are no possible moves which result in a win
+        '''Draws a move from all possible moves available from this box,
+        holding its lock from the bar's beadLocks'''
+        if self.bar.beadLocks is None:
+            return self.takeBead()
+        with self.bar.boxLock(self.state):
+            return self.takeBead()
+
+    def takeBead(self):
+        '''Takes a bead out of the box and returns its move. An empty box
+        is refilled, and -1 returned to resign'''
+        row = self.store.row(self.state)
+        tree = self.store.tree[row]
+        size = len(tree)-1
+        total = 0
+        i = size
+        while i > 0:  # add up every bead in the box
+            total += tree[i]
+            i -= i & -i
+        if total > 0:  # choose one bead
+            remaining = np.random.randint(total)
+            selected = 0
+            step = 1 << (size.bit_length()-1)
+            while step > 0:  # descend to the move holding that bead
+                if selected+step <= size and tree[selected+step] <= remaining:
+                    selected += step
+                    remaining -= tree[selected]
+                step >>= 1
+            self.store.beads[row, selected] -= 1  # decrement
+            self.updateTree(selected, -1, row)
+        else:  # there are no possible moves which result in a win
             selected = -1  # resign as no possible move
+            if self.bar.stats is not None:
+                self.bar.stats.emptyResignations += 1
             # print('RAN OUT OF BEANS IN {}'.format(self.desc))
             self.populate()  # reset to original
         return selected
 
     def replenish(self, winningMove):
-        '''Adds to the dictionary with key winningMove by the bounty amount'''
-        self.moveDict[winningMove] += self.bounty
+        '''Adds to the beads for winningMove by the bounty amount, holding
+        the box's lock from the bar's beadLocks'''
+        if self.bar.beadLocks is None:
+            self.addBeads(winningMove, self.bounty)
+            return
+        with self.bar.boxLock(self.state):
+            self.addBeads(winningMove, self.bounty)
+
+    def addBeads(self, move, count):
+        '''Adds count beads to move without taking the box's lock'''
+        row = self.store.row(self.state)
+        self.store.beads[row, move] += count
+        self.updateTree(move, count, row)
+
+    def updateTree(self, move, change, row=None):
+        '''Adds change to the Fenwick tree entries which count move'''
+        if row is None:
+            row = self.store.row(self.state)
+        tree = self.store.tree[row]
+        i = move+1
+        while i < len(tree):
+            tree[i] += change
+            i += i & -i
+
+
+class BoxList(object):
+    '''A list-like collection of Box views onto the beads in a BeadStore,
+    created as they are asked for'''
+
+    def __init__(self, bar, store):
+        self.bar = bar
+        self.store = store
+
+    def __len__(self):
+        return self.bar.nStates
+
+    def __getitem__(self, state):
+        if not -len(self) <= state < len(self):
+            raise IndexError('box index out of range')
+        return Box(self.bar, state % len(self), self.store)
+
+    def __repr__(self):
+        return repr([box for box in self])
+
+
+class BeadStore(object):
+    '''Holds the beads for the boxes of a bar, creating each box the first
+    time its state is visited
+
+    Each box is one row of self.beads, with a column for every square, and
+    starts with Bar.startingBeads. Rows are added in the order the boxes are
+    created - self.states lists the created states in increasing order and
+    self.stateRows the row holding each of them, so rows are found by a
+    binary search. After materializeAll() every box exists and row n holds
+    state n. Each row of self.tree is a Fenwick tree over the same row of
+    self.beads.
+    '''
+
+    def __init__(self, bar):
+        self.bar = bar
+        self.clear()
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        '''Memory used by the arrays of the store'''
+        return (self.beads.nbytes + self.tree.nbytes +
+                self.states.nbytes + self.stateRows.nbytes)
+
+    def clear(self):
+        '''Removes every box, so each starts again from its starting beads'''
+        width = self.bar.rows*self.bar.cols
+        self.beads = np.zeros([0, width], dtype=int)
+        self.tree = np.zeros([0, width+1], dtype=int)
+        self.states = np.zeros(0, dtype=np.int64)
+        self.stateRows = np.zeros(0, dtype=np.int64)
+        self.size = 0  # rows of self.beads in use
+        self.complete = False  # True once row n holds state n
+
+    def rows(self, states, allocate=True):
+        '''Returns the rows holding the boxes of an array of states, creating
+        any which don't exist yet. With allocate=False, missing boxes give
+        -1 instead'''
+        states = np.asarray(states, dtype=np.int64)
+        if self.complete:
+            return states
+        flat = states.reshape(-1)  # so a single state works too
+        position = np.searchsorted(self.states, flat)
+        found = position < len(self.states)
+        found[found] = self.states[position[found]] == flat[found]
+        if np.all(found):
+            return self.stateRows[position].reshape(states.shape)
+        if allocate:
+            self.allocate(flat[~found])
+            return self.rows(states)
+        rows = np.full(flat.shape, -1, dtype=np.int64)
+        rows[found] = self.stateRows[position[found]]
+        return rows.reshape(states.shape)
+
+    def row(self, state, allocate=True):
+        '''Returns the row holding the box of a single state'''
+        if self.complete:
+            return state
+        position = int(np.searchsorted(self.states, state))
+        if position < len(self.states) and self.states[position] == state:
+            return int(self.stateRows[position])
+        if not allocate:
+            return -1
+        self.allocate(np.array([state]))
+        return self.row(state)
+
+    def allocate(self, states):
+        '''Creates boxes holding the starting beads for an array of states
+        which don't have them yet'''
+        states = np.unique(states)
+        needed = self.size+len(states)
+        if needed > len(self.beads):  # grow by doubling
+            capacity = max(needed, 2*len(self.beads), 16)
+            beads = np.zeros([capacity, self.beads.shape[1]], dtype=int)
+            beads[:self.size] = self.beads[:self.size]
+            tree = np.zeros([capacity, self.tree.shape[1]], dtype=int)
+            tree[:self.size] = self.tree[:self.size]
+            self.beads, self.tree = beads, tree
+        rows = np.arange(self.size, needed)
+        self.beads[rows] = self.bar.startingBeads(states)
+        self.tree[rows] = self.bar.produceBeadTree(self.beads[rows])
+        self.size = needed
+        allStates = np.concatenate([self.states, states])
+        order = np.argsort(allStates, kind='stable')
+        self.states = allStates[order]
+        self.stateRows = np.concatenate([self.stateRows, rows])[order]
+
+    def materializeAll(self):
+        '''Creates every box that doesn't exist yet and puts them in order,
+        so that row n holds state n'''
+        rows = self.rows(np.arange(self.bar.nStates))
+        self.beads = self.beads[rows]
+        self.tree = self.tree[rows]
+        self.size = self.bar.nStates
+        self.states = np.arange(self.size)
+        self.stateRows = np.arange(self.size)
+        self.complete = True
+
+    def refreshTree(self, rows=None):
+        '''Rebuilds the Fenwick trees of some rows (by default all of them)
+        after their beads have been changed in bulk'''
+        if rows is None:
+            rows = np.arange(self.size)
+        self.tree[rows] = self.bar.produceBeadTree(self.beads[rows])
+
+
+class Journal(object):
+    '''Records the training of a bar in a directory, so a run can carry on
+    from where it stopped if the process dies
+
+    The directory holds a checkpoint, checkpoint-<games>.chomp, written by
+    Bar.save after that many games, and journal-<games>.bin, an append-only
+    file of the changes made since. Bar.play and Bar.playBatch report the
+    boxes each game visited, and every flushEvery games one block is
+    appended, holding the bead counts of those boxes and the games played
+    and won. Every checkpointEvery games the journal is compacted: a new
+    checkpoint is saved, and the old checkpoint and journal are deleted.
+
+    Opening a directory which already holds a checkpoint loads it into the
+    bar, then copies in the blocks of its journal - unless resume is False,
+    when the bar's own boxes are checkpointed and the old files deleted. A
+    block cut short by a crash fails its checksum, and is cut off the end
+    of the file. Only the games since the last flush are lost.
+    '''
+
+    blockHeader = struct.Struct('<4sIqqI')  # magic, boxes, played, won, crc
+
+    def __init__(self, bar, directory, flushEvery=1000,
+                 checkpointEvery=100000, resume=True):
+        self.bar = bar
+        self.directory = directory
+        self.flushEvery = flushEvery
+        self.checkpointEvery = checkpointEvery
+        self.dirty = set()  # states changed since the last flush
+        self.pending = 0  # games since the last flush
+        self.file = None
+        os.makedirs(directory, exist_ok=True)
+        games = self.checkpoints()
+        if games and resume:
+            self.resume(games[-1])
+        else:
+            self.checkpoint()
+        bar.journal = self
+
+    def checkpoints(self):
+        '''Returns the number of games of each complete checkpoint, in
+        increasing order'''
+        games = []
+        for name in os.listdir(self.directory):
+            if name.startswith('checkpoint-') and name.endswith('.chomp'):
+                if isModel(os.path.join(self.directory, name)):
+                    games.append(int(name[len('checkpoint-'):-len('.chomp')]))
+        return sorted(games)
+
+    def path(self, kind, games):
+        '''Returns the path of the checkpoint or journal for games'''
+        extension = '.chomp' if kind == 'checkpoint' else '.bin'
+        return os.path.join(self.directory,
+                            '{}-{}{}'.format(kind, games, extension))
+
+    def resume(self, games):
+        '''Loads the checkpoint after games into the bar, then applies
+        every complete block of its journal'''
+        bar = self.bar
+        bar.load(self.path('checkpoint', games))
+        store = bar.boxStore
+        width = bar.rows*bar.cols
+        journal = self.path('journal', games)
+        good = 0  # bytes of the journal holding complete blocks
+        if os.path.exists(journal):
+            with open(journal, 'rb') as f:
+                data = f.read()
+            size = self.blockHeader.size
+            while good+size <= len(data):
+                magic, n, played, won, crc = self.blockHeader.unpack_from(
+                    data, good)
+                end = good+size+8*n*(width+1)
+                if magic != b'CJNL' or end > len(data):
+                    break
+                payload = data[good+size:end]
+                if zlib.crc32(payload) != crc:
+                    break
+                states = np.frombuffer(payload, dtype='<i8', count=n)
+                beads = np.frombuffer(payload, dtype='<i8', offset=8*n)
+                rows = store.rows(states)
+                store.beads[rows] = beads.reshape(n, width)
+                bar.gamesPlayed, bar.gamesWon = played, won
+                good = end
+            if good < len(data):
+                print('Discarded {} bytes from the end of {}'.format(
+                    len(data)-good, journal))
+        bar.refreshBeadTree()
+        self.open(games, good)
+
+    def open(self, games, length=0):
+        '''Opens the journal following the checkpoint after games for
+        appending, cutting it to length bytes'''
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.path('journal', games), 'ab')
+        self.file.truncate(length)
+        self.checkpointGames = games
+
+    def gameOver(self, states, games=1):
+        '''Notes that games have been played which changed the boxes of
+        states, an iterable of state numbers, flushing and compacting the
+        journal when they are due'''
+        self.dirty.update(states)
+        self.pending += games
+        if self.pending >= self.flushEvery:
+            self.flush()
+            if (self.bar.gamesPlayed-self.checkpointGames >=
+                    self.checkpointEvery):
+                self.checkpoint()
+
+    def flush(self):
+        '''Appends one block holding the beads of every box changed since
+        the last flush'''
+        if self.pending == 0 and not self.dirty:
+            return
+        bar = self.bar
+        states = np.array(sorted(self.dirty), dtype='<i8')
+        rows = bar.boxStore.rows(states)  # may reallocate the beads
+        beads = bar.boxStore.beads[rows].astype('<i8')
+        payload = states.tobytes() + beads.tobytes()
+        self.file.write(self.blockHeader.pack(
+            b'CJNL', len(states), bar.gamesPlayed, bar.gamesWon,
+            zlib.crc32(payload)))
+        self.file.write(payload)
+        self.file.flush()
+        self.dirty.clear()
+        self.pending = 0
+
+    def checkpoint(self):
+        '''Saves every box as a new checkpoint and starts a new journal,
+        then deletes the older ones'''
+        games = self.bar.gamesPlayed
+        if self.file is not None:
+            self.flush()
+            if games == self.checkpointGames:
+                return
+            os.fsync(self.file.fileno())
+        final = self.path('checkpoint', games)
+        temporary = final + '.tmp'
+        shutil.rmtree(temporary, ignore_errors=True)
+        self.bar.save(temporary)
+        shutil.rmtree(final, ignore_errors=True)
+        os.replace(temporary, final)
+        self.open(games)
+        for old in self.checkpoints():
+            if old != games:
+                shutil.rmtree(self.path('checkpoint', old))
+        for name in os.listdir(self.directory):
+            if (name.startswith('journal-') and
+                    name != os.path.basename(self.path('journal', games))):
+                os.remove(os.path.join(self.directory, name))
+
+    def close(self):
+        '''Flushes the journal and closes it'''
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+        if self.bar.journal is self:
+            self.bar.journal = None
+
+
+class Game(object):
+    '''One game of Chomp against the machine, played a step at a time
+
+    A game keeps its own position - a bitboard of the squares eaten, one
+    for each player, its state number and description - and the lists of
+    positions and moves that Bar.play used to hold, so many games can be
+    in progress at once against the boxes of one bar. __slots__ keeps each
+    one small.
+
+    Player 1 is the machine and player 2 its opponent. start(whofirst)
+    sets up the full bar, then apply(move) makes the move of whichever
+    player's turn it is, -1 resigning. machineMove() draws the machine's
+    move from its box and applies it. Once a player resigns, finish()
+    replenishes the winner's moves and updates the bar's records. After
+    bar.shareBetweenThreads(), games can be played from several threads.
+    With bar.debug set, apply() checks the state after every move.
+
+    Example: the machine plays itself, one step at a time
+
+        In: game = Game(Bar(), 'intelligent')
+        In: game.start(1)
+        In: while not game.finished: game.machineMove()
+        In: game.finish()
+
+    '''
+
+    __slots__ = ['bar', 'opponent', 'board', 'playerBoards', 'state', 'desc',
+                 'whofirst', 'player', 'positionList', 'pcMoveList',
+                 'opponentMoveList', 'finished', 'winner']
+
+    def __init__(self, bar, opponent='human'):
+        self.bar = bar
+        self.opponent = opponent  # recorded by a GameLog
+        self.start(1)
+
+    def start(self, whofirst):
+        '''Starts again from the full bar, with player whofirst (1 or 2) to
+        move'''
+        if whofirst not in [1, 2]:
+            raise ValueError('whofirst must be 1 or 2')
+        bar = self.bar
+        self.board = 0
+        self.playerBoards = {}
+        self.desc = np.full(bar.cols, bar.rows, dtype=int)
+        self.state = bar.nStates-1
+        self.whofirst = whofirst
+        self.player = whofirst  # whose turn it is
+        self.positionList = []
+        self.pcMoveList = []
+        self.opponentMoveList = []
+        self.finished = False  # game over if this is True
+        self.winner = -1  # don't know the winner yet
+
+    def legalMoves(self):
+        '''Returns a list of the squares the player to move can eat'''
+        return self.bar.availableSquares(self.board)
+
+    def apply(self, move):
+        '''Makes move for the player whose turn it is, -1 to resign, and
+        returns the winner, or -1 while the game goes on'''
+        if self.finished:
+            raise ValueError('The game is over')
+        player = self.player
+        self.positionList.append(self.state)
+        if move == -1:  # resigns, so the other player wins
+            self.finished = True
+            self.winner = 3-player
+            return self.winner
+        if move <= 0 or self.board >> move & 1:
+            raise ValueError('Square {} can\'t be eaten'.format(move))
+        bite = self.bar.quadrants[move]
+        self.playerBoards[player] = (self.playerBoards.get(player, 0) |
+                                     bite & ~self.board)
+        self.board |= bite
+        self.state = self.bar.biteDescription(self.desc, self.state, move)
+        if self.bar.debug:
+            self.checkState()
+        if player == 1:
+            self.pcMoveList.append(move)
+        else:
+            self.opponentMoveList.append(move)
+        self.player = 3-player
+        return self.winner
+
+    def checkState(self):
+        '''Raises an error if the game's state number doesn't match the
+        state worked out again from its bitboard, as Bar.checkState does'''
+        bar = self.bar
+        recognised = int(bar.descriptionToStateNumber(
+            bar.convertBooleanToDescription(bar.bitboardToBoolean(
+                self.board))))
+        if recognised != self.state:
+            raise RuntimeError('Cached state {} does not match state {}'
+                               .format(self.state, recognised))
+
+    def drawMove(self):
+        '''Draws a move from the box of the current state, or -1 if it is
+        empty'''
+        return self.bar.boxes[self.state].draw()
+
+    def randomMove(self):
+        '''Picks one of the legal moves at random, or -1 if there are none'''
+        return self.bar.pickRandomAvailableSquareToEat(self.board)
+
+    def perfectMove(self):
+        '''Picks one of the moves perfect play would make, or -1'''
+        moves = self.bar.optimalMoves(self.state)
+        if len(moves) == 0:
+            return -1  # resign
+        return int(np.random.choice(moves))
+
+    def machineMove(self):
+        '''Draws the machine's move from its box and applies it, returning
+        the move'''
+        move = self.drawMove()
+        self.apply(move)
+        return move
+
+    def finish(self, display=False):
+        '''Replenishes the moves made by the winner, counts the game in the
+        bar's records, and returns the winner'''
+        if not self.finished:
+            raise ValueError('The game is not over')
+        bar = self.bar
+        positionList = self.positionList
+        chompPositions = positionList[self.whofirst-1::2]
+        opponentPositions = positionList[2-self.whofirst::2]
+        if self.winner == 1:
+            winMoveList, winPositionList = self.pcMoveList, chompPositions
+        else:
+            winMoveList = self.opponentMoveList
+            winPositionList = opponentPositions
+        for move, position in zip(winMoveList, winPositionList):
+            if display:
+                print('Boosting move {} in box {}'.format(move, position))
+            bar.boxes[position].replenish(move)
+        with bar.recordLock or unlocked:
+            bar.gamesPlayed += 1
+            bar.gamesWon += self.winner == 1
+            if bar.journal is not None:  # the boxes drawn from or boosted
+                changed = set(chompPositions) | set(winPositionList)
+                if self.opponent == 'intelligent':
+                    changed.update(opponentPositions)
+                bar.journal.gameOver(changed)
+            if bar.gameLog is not None:
+                first, second = self.pcMoveList, self.opponentMoveList
+                if self.whofirst == 2:
+                    first, second = second, first
+                moves = np.full(len(positionList), -1)  # last ply resigns
+                moves[0:-1:2] = first
+                moves[1:-1:2] = second
+                bar.gameLog.append([positionList], [moves], self.whofirst,
+                                   self.winner, self.opponent)
+        return self.winner
+
+    def toBar(self):
+        '''Copies the position onto the bar, so that its show methods and
+        self.eaten describe this game'''
+        bar = self.bar
+        bar.board = self.board
+        bar.playerBoards = dict(self.playerBoards)
+        bar.currentDesc = self.desc.copy()
+        bar.currentState = self.state
+        bar.finished = self.finished
+
+
+class PlayStats(object):
+    '''Profiles the games a bar plays with Bar.play
+
+    Creating one sets bar.stats, and play() then adds the time it spends
+    in each phase of a game to self.times: 'recognise' (finding the current
+    state), 'draw' (Chomp drawing a move from its box), 'opponent' (the
+    opponent choosing a move), 'eat' and 'reinforce' (replenishing the
+    winning moves). It also counts the games and plies, how many times
+    Chomp resigned because its box was empty, how many boxes were refilled
+    by Box.populate, and how often each state was visited.
+
+    With samples, the last samples games are also kept in self.ring, a
+    structured array holding each game's number, plies, winner, duration
+    and the refills up to it, written round in a circle - recent()
+    returns them oldest first.
+
+    Example: find out where training time goes
+
+        In: b = Bar()
+        In: PlayStats(b)
+        In: for i in range(1000): b.play('intelligent')
+        In: b.stats.report()
+
+    Set bar.stats back to None to stop profiling.
+    '''
+
+    phases = ['recognise', 'draw', 'opponent', 'eat', 'reinforce']
+    sampleDtype = np.dtype([('game', np.int64), ('plies', np.int32),
+                            ('winner', np.int8), ('seconds', np.float64),
+                            ('refills', np.int64)])
+
+    def __init__(self, bar, samples=0):
+        self.bar = bar
+        self.ring = np.zeros(samples, dtype=self.sampleDtype)
+        self.clear()
+        bar.stats = self
+
+    def clear(self):
+        '''Sets every timer and counter back to zero'''
+        self.times = dict.fromkeys(self.phases, 0.0)
+        self.games = 0
+        self.plies = 0
+        self.seconds = 0.0  # in play(), from choosing the opponent
+        self.emptyResignations = 0
+        self.refills = 0
+        self.visits = Counter()  # state number: times visited
+
+    def timed(self, phase, fn):
+        '''Returns a function which calls fn and adds the time it took to
+        self.times[phase]'''
+        times = self.times
+
+        def wrapper(*args):
+            start = perf_counter()
+            result = fn(*args)
+            times[phase] += perf_counter()-start
+            return result
+        return wrapper
+
+    def gameOver(self, positionList, winner, seconds):
+        '''Counts a finished game which visited positionList'''
+        self.games += 1
+        self.plies += len(positionList)
+        self.seconds += seconds
+        self.visits.update(positionList)
+        if len(self.ring):
+            self.ring[(self.games-1) % len(self.ring)] = (
+                self.games, len(positionList), winner, seconds, self.refills)
+
+    def recent(self):
+        '''Returns the sampled games in the ring buffer, oldest first'''
+        if self.games < len(self.ring):
+            return self.ring[:self.games].copy()
+        return np.roll(self.ring, -(self.games % len(self.ring)))
+
+    def report(self):
+        '''Prints a summary of the timers and counters'''
+        games = max(self.games, 1)
+        print('{} games, {:.2f} plies per game, {:.3g} ms per game'.format(
+            self.games, self.plies/games, 1000*self.seconds/games))
+        for phase in self.phases:
+            print('  {:10} {:6.1f} percent'.format(
+                phase, 100*self.times[phase]/max(self.seconds, 1e-12)))
+        print('{} resignations from empty boxes, {} refills - {:.3f} per '
+              'game'.format(self.emptyResignations, self.refills,
+                            self.refills/games))
+        print('Most visited states: {}'.format(
+            ', '.join('{} ({})'.format(state, count)
+                      for state, count in self.visits.most_common(5))))
+
+
+class GameLog(object):
+    '''Writes every game played by a bar to a file, one fixed-width record
+    per game
+
+    The file starts with a short header giving the size of the bar, then
+    holds a record of dtype gameDtype(rows, cols) for each game: the state
+    before every ply, the move made from it, who went first, the winner and
+    the opponent, as an index into opponents. Unused plies hold -1, and the
+    last ply of a game is always the resignation, with move -1. Records are
+    kept in a buffer of bufferSize games and written out together, so
+    loadGames() can memory-map the file while it is still growing.
+
+    Example: log some games, then rebuild the boxes with a different bounty
+
+        In: b = Bar()
+        In: GameLog(b, 'games.log')
+        In: b.playBatch('random', 1000)
+        In: b.gameLog.close()
+        In: b.replay('games.log', bounty=5)
+
+    '''
+
+    header = struct.Struct('<4sHHH')  # magic, version, rows, cols
+
+    def __init__(self, bar, filename, bufferSize=10000):
+        self.bar = bar
+        self.filename = filename
+        self.dtype = gameDtype(bar.rows, bar.cols)
+        self.buffer = np.zeros(bufferSize, dtype=self.dtype)
+        self.size = 0  # records in the buffer
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            header, log = loadGames(filename)
+            if (header['rows'], header['cols']) != (bar.rows, bar.cols):
+                raise ValueError('{} holds games for a {}x{} bar'.format(
+                    filename, header['rows'], header['cols']))
+            length = self.header.size + len(log)*self.dtype.itemsize
+            log = None
+            self.file = open(filename, 'ab')
+            self.file.truncate(length)  # drop any half-written record
+        else:
+            self.file = open(filename, 'wb')
+            self.file.write(self.header.pack(b'CGML', 1, bar.rows, bar.cols))
+        bar.gameLog = self
+
+    def append(self, states, moves, whofirst, winner, opponent):
+        '''Adds games to the log. states and moves hold a row for each game,
+        which may be shorter than the record and is padded with -1'''
+        n = len(states)
+        if self.size+n > len(self.buffer):
+            self.flush()
+            if n > len(self.buffer):
+                self.buffer = np.zeros(n, dtype=self.dtype)
+        records = self.buffer[self.size:self.size+n]
+        records['states'] = -1
+        records['moves'] = -1
+        for field, values in [('states', states), ('moves', moves)]:
+            values = np.asarray(values)
+            records[field][:, :values.shape[1]] = values
+        records['whofirst'] = whofirst
+        records['winner'] = winner
+        records['opponent'] = opponents.index(opponent)
+        self.size += n
+
+    def flush(self):
+        '''Writes the buffered games to the file'''
+        self.file.write(self.buffer[:self.size].tobytes())
+        self.file.flush()
+        self.size = 0
+
+    def appendLog(self, filename):
+        '''Adds every game in another log file to the end of this one'''
+        header, log = loadGames(filename)
+        if (header['rows'], header['cols']) != (self.bar.rows, self.bar.cols):
+            raise ValueError('{} holds games for a {}x{} bar'.format(
+                filename, header['rows'], header['cols']))
+        self.flush()
+        self.file.write(np.asarray(log).tobytes())
+        self.file.flush()
+
+    def close(self):
+        '''Writes the buffered games and closes the file'''
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+        if self.bar.gameLog is self:
+            self.bar.gameLog = None
+
+
+def gameDtype(rows, cols):
+    """Returns the numpy dtype of a GameLog record for a rows by cols bar"""
+    plies = rows*cols  # every bite eats at least one square
+    stateType = '<i4' if comb(rows+cols, cols) < 2**31 else '<i8'
+    return np.dtype([('states', stateType, plies), ('moves', '<i2', plies),
+                     ('whofirst', 'u1'), ('winner', 'u1'),
+                     ('opponent', 'u1')])
+
+
+def loadGames(filename, mmapMode='r'):
+    """Reads a file written by GameLog, returning its header as a dictionary
+    and its records as an array, memory-mapped with mode mmapMode. A record
+    cut short at the end of the file is left out"""
+    with open(filename, 'rb') as f:
+        magic, version, rows, cols = GameLog.header.unpack(
+            f.read(GameLog.header.size))
+    if magic != b'CGML':
+        raise ValueError('{} is not a chomp game log'.format(filename))
+    if version > 1:
+        raise ValueError('{} is game log version {}, newer than version 1'
+                         .format(filename, version))
+    dtype = gameDtype(rows, cols)
+    count = (os.path.getsize(filename)-GameLog.header.size)//dtype.itemsize
+    header = {'version': version, 'rows': rows, 'cols': cols,
+              'games': count}
+    if count == 0:
+        return header, np.zeros(0, dtype=dtype)
+    log = np.memmap(filename, dtype=dtype, mode=mmapMode,
+                    offset=GameLog.header.size, shape=count)
+    return header, log
+
+
+class LegacyBox(object):
+    '''Stands in for Box when unpickling files saved while each Box held its
+    own moveDict'''
+
+
+class BoxUnpickler(pickle.Unpickler):
+    '''Unpickles saved boxes, reading old Box objects as LegacyBox. Only the
+    numpy classes needed for bead counts may be loaded, so a pickle file
+    can't run anything else'''
+
+    allowed = {('numpy', 'ndarray'), ('numpy', 'dtype'),
+               ('numpy.core.multiarray', '_reconstruct'),
+               ('numpy.core.multiarray', 'scalar'),
+               ('numpy._core.multiarray', '_reconstruct'),
+               ('numpy._core.multiarray', 'scalar'),
+               ('numpy.core.numeric', '_frombuffer'),
+               ('numpy._core.numeric', '_frombuffer')}
+
+    def find_class(self, module, name):
+        if name == 'Box':
+            return LegacyBox
+        if (module, name) not in self.allowed:
+            raise pickle.UnpicklingError('{}.{} is not allowed in a box file'
+                                         .format(module, name))
+        return super().find_class(module, name)
+
+
+def isModel(filename):
+    """Returns True if filename is a model directory written by Bar.save, or
+    a file inside one"""
+    if not os.path.isdir(filename):
+        filename = os.path.dirname(filename)
+    return os.path.exists(os.path.join(filename, 'header.json'))
+
+
+def loadModel(filename, mmapMode='r'):
+    """Reads a model directory written by Bar.save (or a file inside one),
+    returning its header as a dictionary and its arrays of states and beads,
+    opened with np.load(mmap_mode=mmapMode) - so by default they are
+    memory-mapped read-only rather than read into memory"""
+    if not os.path.isdir(filename):
+        filename = os.path.dirname(filename)
+    with open(os.path.join(filename, 'header.json'), 'r') as f:
+        header = json.load(f)
+    if header.get('format') != 'chomp-model':
+        raise ValueError('{} is not a chomp model'.format(filename))
+    if header['version'] > modelVersion:
+        raise ValueError('{} is model version {}, newer than version {}'
+                         .format(filename, header['version'], modelVersion))
+    states = np.load(os.path.join(filename, 'states.npy'),
+                     mmap_mode=mmapMode)
+    beads = np.load(os.path.join(filename, 'beads.npy'), mmap_mode=mmapMode)
+    return header, states, beads
 
 
 def menu():
@@ -676,6 +2337,8 @@ def menu():
 if __name__ == '__main__':
     w = []  # win log
     b = Bar()  # create bar
+    journalDir = 'training-journal'
+    loaded = False  # True once a model has been loaded
     loop = True
     while loop:
         choice = menu()
@@ -687,20 +2350,33 @@ if __name__ == '__main__':
                 if q == 'n':
                     playLoop = False
         elif choice == 2:
-            for i in range(10000):
-                b.play('intelligent', display=False)
+            if b.journal is None:
+                resume = False
+                if loaded:  # keep the loaded model
+                    print('Starting a new journal for the loaded model')
+                elif os.path.isdir(journalDir) and os.listdir(journalDir):
+                    resume = input('Carry on from the training in {}? '
+                                   '([y]/n) '.format(journalDir)) != 'n'
+                Journal(b, journalDir, resume=resume)
+            b.train(10000, 'intelligent', progressEvery=5)
+            b.journal.flush()
             print('Trained')
         elif choice == 3:
             fname = input('Type the filename to save: ')
             b.save(fname)
         elif choice == 4:
             filename = askopenfilename()  # show an "Open" dialog box
+            if b.journal is not None:  # it recorded the boxes being replaced
+                b.journal.close()
             b.load(filename)
+            loaded = True
         elif choice == 5:
             b.show()
             b.record()
             b.showBoxChoices()
         elif choice == 0:
+            if b.journal is not None:
+                b.journal.close()
             loop = False  # exit
         else:
             pass
@@ -5,32 +5,147 @@ Created on Wed Dec 20 11:13:02 2017
 
 Creates art for the chomp game
 
+Every state of the bar gets a picture, made by laying a square tile (the
+poisoned tile in the top left corner) wherever a square is left, on a
+black background. The pictures are composed a chunk of states at a time
+with numpy broadcasting from Bar.allStates and each file is written once.
+A manifest in the output folder records a hash of what went into every
+picture, so pictures whose tiles and state haven't changed are skipped.
+Large sets are spread over a process pool.
+
+Example: the 6x6 physical set
+
+    python chompArt.py --rows 6 --cols 6 --out Art/ngcm6x6
+
 @author: dan
 """
-import scipy as sp
+import argparse
+import hashlib
+import json
+import os
+from multiprocessing import Pool
 import numpy as np
+import matplotlib.image as mpimg
+from PIL import Image
 from chomp import Bar
 
-a = Bar()
-states = a.allStates
-r = a.rows
-c = a.cols
-sqr = sp.misc.imread('Art/ngcmSquare.png')
-bad = sp.misc.imread('Art/ngcmBadSquare.png')
-pixh = sqr.shape[0]
-pixv = sqr.shape[1]
-imageArray = np.ones([r*pixh, c*pixv, sqr.shape[2]])
-sp.misc.imsave('Art/ngcm0.png', imageArray)
-for i, state in enumerate(states):
-    state = np.reshape(state, [r, c])
-    imageArray = np.ones([r*pixh, c*pixv, sqr.shape[2]])
-    for j in range(r):
-        for k in range(c):
-            if (j == 0 and k == 0):
-                img = bad
-            else:
-                img = sqr
-            if not state[j, k]:
-                imageArray[j*pixh:(j+1)*pixh,
-                           k*pixv:(k+1)*pixv, :] = img
-                sp.misc.imsave('Art/ngcm{}.png'.format(i), imageArray)
+here = os.path.dirname(os.path.abspath(__file__))
+artDir = os.path.normpath(os.path.join(here, '..', 'Art', 'ngcm'))
+
+
+def loadTile(filename):
+    """Reads a tile image as an array of 8-bit RGB values"""
+    tile = mpimg.imread(filename)[..., :3]
+    if tile.dtype != np.uint8:
+        tile = np.round(tile*255).astype(np.uint8)
+    return tile
+
+
+def composeStates(states, rows, cols, square, bad, background=0):
+    """Returns an array of shape (states, rows*height, cols*width, 3)
+    holding the picture of each state in a boolean array of states, with
+    square (or bad, for square 0) wherever a square is left"""
+    height, width = square.shape[:2]
+    tiles = np.broadcast_to(square, (rows, cols) + square.shape).copy()
+    tiles[0, 0] = bad
+    left = ~np.reshape(states, [-1, rows, cols])[..., None, None, None]
+    images = np.where(left, tiles, np.uint8(background))
+    images = images.transpose(0, 1, 3, 2, 4, 5)
+    return images.reshape(len(images), rows*height, cols*width, 3)
+
+
+def stateHash(state, rows, cols, tileHash, background=0):
+    """Returns a hash of everything which goes into a state's picture"""
+    key = hashlib.sha1(tileHash.encode())
+    key.update(np.packbits(state).tobytes())
+    key.update('{}x{} {}'.format(rows, cols, background).encode())
+    return key.hexdigest()
+
+
+def drawChunk(job):
+    """Composes and writes the pictures for a chunk of states, returning
+    their file names"""
+    names, states, rows, cols, squareFile, badFile, background = job
+    images = composeStates(states, rows, cols, loadTile(squareFile),
+                           loadTile(badFile), background)
+    for name, image in zip(names, images):
+        Image.fromarray(image).save(name, compress_level=1)
+    return names
+
+
+def drawArt(rows=3, cols=4, outDir=artDir, prefix='ngcm',
+            squareFile=os.path.join(artDir, 'ngcmSquare.png'),
+            badFile=os.path.join(artDir, 'ngcmBadSquare.png'),
+            chunk=16, processes=None, force=False, background=0):
+    """Writes a picture of every state of a rows by cols bar into outDir,
+    named prefix followed by the state number, and returns the names of
+    the files written. Pictures already there with the same inputs are
+    skipped unless force is True. processes=1 draws everything in this
+    process, and by default a pool is only used for more than 4 chunks.
+    background is the grey level left where squares have been eaten.
+    """
+    states = Bar(rows, cols).allStates
+    os.makedirs(outDir, exist_ok=True)
+    tileHash = hashlib.sha1()
+    for filename in [squareFile, badFile]:
+        with open(filename, 'rb') as f:
+            tileHash.update(f.read())
+    tileHash = tileHash.hexdigest()
+
+    manifestFile = os.path.join(outDir, prefix + '-manifest.json')
+    manifest = {}
+    if os.path.exists(manifestFile) and not force:
+        with open(manifestFile, 'r') as f:
+            manifest = json.load(f)
+    todo = []
+    hashes = {}
+    for i, state in enumerate(states):
+        name = os.path.join(outDir, '{}{}.png'.format(prefix, i))
+        hashes[name] = stateHash(state, rows, cols, tileHash, background)
+        key = os.path.basename(name)
+        if manifest.get(key) != hashes[name] or not os.path.exists(name):
+            todo.append(i)
+    print('{} pictures to draw, {} unchanged'.format(
+        len(todo), len(states)-len(todo)))
+
+    parts = [todo[k:k+chunk] for k in range(0, len(todo), chunk)]
+    jobs = [([os.path.join(outDir, '{}{}.png'.format(prefix, i))
+              for i in part], states[part], rows, cols, squareFile, badFile,
+             background)
+            for part in parts]
+    if processes == 1 or len(jobs) <= 4:
+        written = [drawChunk(job) for job in jobs]
+    else:
+        with Pool(processes) as pool:
+            written = pool.map(drawChunk, jobs)
+    written = [name for names in written for name in names]
+
+    manifest.update((os.path.basename(name), hashes[name])
+                    for name in written)
+    temporary = manifestFile + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(manifest, f, indent=0, sort_keys=True)
+    os.replace(temporary, manifestFile)
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Draw a picture of every state of a chomp bar')
+    parser.add_argument('--rows', type=int, default=3)
+    parser.add_argument('--cols', type=int, default=4)
+    parser.add_argument('--out', default=artDir,
+                        help='folder for the pictures')
+    parser.add_argument('--prefix', default='ngcm')
+    parser.add_argument('--square',
+                        default=os.path.join(artDir, 'ngcmSquare.png'))
+    parser.add_argument('--bad',
+                        default=os.path.join(artDir, 'ngcmBadSquare.png'),
+                        help='tile for the poisoned square')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes (default: all cores)')
+    parser.add_argument('--force', action='store_true',
+                        help='redraw pictures even if unchanged')
+    args = parser.parse_args()
+    drawArt(args.rows, args.cols, args.out, args.prefix, args.square,
+            args.bad, processes=args.processes, force=args.force)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Times the hot paths of Bar and Box across sizes of bar, and compares runs
+
+Each benchmark is timed like timeit: the call is repeated until a batch
+takes a useful length of time, several batches are run, and the best time
+per call is kept along with the median. Bars are built with cacheDir=None
+so no cached tables are read, and nothing needs a network connection.
+Results are saved as JSON, keyed by '<rows>x<cols>/<benchmark>', with a
+note of the Python and numpy versions and the machine they ran on.
+
+compare reads two result files and lists the ratio of new to old time for
+every benchmark they share, flagging those which are more than threshold
+slower (or faster) - it exits with status 1 if anything got slower.
+
+Example: time the default sizes, change something, then compare
+
+    python chompBench.py run --out before.json
+    python chompBench.py run --out after.json
+    python chompBench.py compare before.json after.json
+
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import timeit
+import numpy as np
+from chomp import Bar
+
+defaultSizes = ['3x4', '5x5', '6x6', '8x8', '10x10']
+
+
+def timeCall(fn, repeat=5, minTime=0.2):
+    """Returns the best and median time in seconds of one call to fn"""
+    timer = timeit.Timer(fn)
+    number, total = timer.autorange()
+    number = max(1, int(number*minTime/max(total, 1e-9)))
+    times = np.array(timer.repeat(repeat, number))/number
+    return float(np.min(times)), float(np.median(times))
+
+
+def playOut(bar):
+    """Returns a function which eats a random game's worth of squares from
+    the full bar, for timing eat()"""
+    np.random.seed(0)
+    bar.resetEaten()
+    moves = []
+    move = bar.pickRandomAvailableSquareToEat()
+    while move != -1:
+        moves.append(move)
+        bar.eat(move, 1)
+        move = bar.pickRandomAvailableSquareToEat()
+
+    def run():
+        bar.resetEaten()
+        for move in moves:
+            bar.eat(move, 1)
+    return run
+
+
+def drawAndReplenish(bar, beads):
+    """Returns a function which draws a bead from the box of the full bar,
+    which holds beads beads per legal move, and puts it back"""
+    bar.bounty = 1
+    box = bar.boxes[bar.nStates-1]
+    row = bar.boxStore.row(box.state)
+    bar.boxStore.beads[row] = np.where(bar.legalMoves(box.state), beads, 0)
+    bar.boxStore.refreshTree([row])
+
+    def run():
+        move = box.draw()
+        box.replenish(move)
+    return run
+
+
+def playGames(bar, opponent):
+    """Returns a function which plays one game against opponent"""
+    return lambda: bar.play(opponent)
+
+
+def buildTables(rows, cols):
+    """Returns a function which builds a bar and the tables it plays with,
+    as a bar does without a cache"""
+    def run():
+        bar = Bar(rows, cols, cacheDir=None)
+        return bar.allStates, bar.nextState, bar.legal
+    return run
+
+
+def halfEaten(bar):
+    """Eats half of the bar, so recogniseState() has a typical state"""
+    bar.eat(bar.rows//2*bar.cols + bar.cols//2, 1)
+    return bar.recogniseState
+
+
+# each benchmark takes (rows, cols) and returns the function to time
+benchmarks = {
+    'construct': lambda r, c: lambda: Bar(r, c, cacheDir=None),
+    'buildTables': buildTables,
+    'enumerateStates': lambda r, c: Bar(r, c, cacheDir=None).enumerateStates,
+    'recogniseState': lambda r, c: halfEaten(Bar(r, c, cacheDir=None)),
+    'eat': lambda r, c: playOut(Bar(r, c, cacheDir=None)),
+    'pickRandomAvailableSquareToEat':
+        lambda r, c: Bar(r, c, cacheDir=None).pickRandomAvailableSquareToEat,
+    'drawFewBeads':
+        lambda r, c: drawAndReplenish(Bar(r, c, cacheDir=None), 1),
+    'drawManyBeads':
+        lambda r, c: drawAndReplenish(Bar(r, c, cacheDir=None), 1000),
+    'playRandom':
+        lambda r, c: playGames(Bar(r, c, cacheDir=None), 'random'),
+    'playIntelligent':
+        lambda r, c: playGames(Bar(r, c, cacheDir=None), 'intelligent'),
+}
+
+
+def run(sizes, names=None, repeat=5, minTime=0.2):
+    """Times every benchmark in names (by default all of them) for each
+    size of bar, given as strings like '3x4', and returns the results as
+    a dictionary"""
+    results = {}
+    for size in sizes:
+        rows, cols = (int(n) for n in size.split('x'))
+        for name in names or benchmarks:
+            np.random.seed(0)
+            fn = benchmarks[name](rows, cols)
+            best, median = timeCall(fn, repeat, minTime)
+            results['{}/{}'.format(size, name)] = {'best': best,
+                                                   'median': median}
+            print('{:>6} {:32} {:>12.3g} s {:>12.0f} /s'.format(
+                size, name, best, 1/best))
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.platform(),
+            'processor': platform.processor(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'results': results}
+
+
+def compare(old, new, threshold=0.1):
+    """Prints the ratio of the new to the old best time for every benchmark
+    in both result dictionaries, and returns the names of those which got
+    more than threshold slower"""
+    slower = []
+    for key in sorted(set(old['results']) & set(new['results'])):
+        ratio = new['results'][key]['best']/old['results'][key]['best']
+        if ratio > 1+threshold:
+            flag = 'REGRESSION'
+            slower.append(key)
+        elif ratio < 1/(1+threshold):
+            flag = 'faster'
+        else:
+            flag = ''
+        print('{:40} {:>8.2f}x {}'.format(key, ratio, flag))
+    if old['machine'] != new['machine']:
+        print('Warning: the runs were on different machines')
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the hot paths of chomp')
+    commands = parser.add_subparsers(dest='command', required=True)
+    runParser = commands.add_parser('run', help='time the benchmarks')
+    runParser.add_argument('--sizes', nargs='+', default=defaultSizes,
+                           help='sizes of bar, like 3x4')
+    runParser.add_argument('--only', nargs='+', choices=list(benchmarks),
+                           help='benchmarks to run (default: all)')
+    runParser.add_argument('--repeat', type=int, default=5)
+    runParser.add_argument('--minTime', type=float, default=0.2,
+                           help='seconds each repeat should take')
+    runParser.add_argument('--out', default='bench.json')
+    compareParser = commands.add_parser('compare',
+                                        help='compare two result files')
+    compareParser.add_argument('old')
+    compareParser.add_argument('new')
+    compareParser.add_argument('--threshold', type=float, default=0.1,
+                               help='fraction slower to flag')
+    args = parser.parse_args()
+    if args.command == 'run':
+        report = run(args.sizes, args.only, args.repeat, args.minTime)
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        with open(args.old, 'r') as f:
+            old = json.load(f)
+        with open(args.new, 'r') as f:
+            new = json.load(f)
+        if compare(old, new, args.threshold):
+            sys.exit(1)
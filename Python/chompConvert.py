@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Converts pickled chomp boxes into model directories
+
+Older games were saved by pickling a list of Box objects, and
+Results/training-record.py pickled a list of dictionaries of bead counts.
+Each file given (by default every .pkl file in stored-games) is read with
+Bar.loadPickle, which also takes the bounty and bead bounds the boxes were
+trained with, and written next to it by Bar.save as a model directory with
+the same name ending in .chomp. The model is then loaded back and checked
+against the pickle before moving on.
+
+Example: convert everything in stored-games
+
+    python chompConvert.py
+
+"""
+import argparse
+import glob
+import os
+import numpy as np
+from chomp import Bar, loadModel
+
+here = os.path.dirname(os.path.abspath(__file__))
+storedGames = os.path.normpath(os.path.join(here, '..', 'stored-games'))
+
+
+def convert(filename, rows=3, cols=4):
+    """Converts the pickle file filename into a model directory and returns
+    the directory's name"""
+    bar = Bar(rows, cols, cacheDir=None)
+    bar.loadPickle(filename)
+    model = os.path.splitext(filename)[0] + '.chomp'
+    bar.save(model)
+
+    header, states, beads = loadModel(model)
+    store = bar.boxStore
+    settings = (bar.bounty, bar.maxBeads, bar.minBeads)
+    if not (np.array_equal(states, store.states) and
+            np.array_equal(beads, store.beads[store.stateRows]) and
+            (header['bounty'], header['maxBeads'],
+             header['minBeads']) == settings):
+        raise RuntimeError('{} does not match {}'.format(model, filename))
+    print('{} -> {}: {} boxes, {} beads'.format(
+        filename, model, header['boxes'], int(np.sum(beads))))
+    return model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert pickled chomp boxes into model directories')
+    parser.add_argument('files', nargs='*',
+                        help='pickle files (default: stored-games/*.pkl)')
+    parser.add_argument('--rows', type=int, default=3)
+    parser.add_argument('--cols', type=int, default=4)
+    args = parser.parse_args()
+    files = args.files or sorted(glob.glob(os.path.join(storedGames,
+                                                         '*.pkl')))
+    for filename in files:
+        convert(filename, args.rows, args.cols)
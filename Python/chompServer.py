@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Hosts many games of Chomp at once against one learning machine
+
+The server runs on asyncio, so one process can serve every table at an
+event. Each connection plays one game after another against the same
+Bar, drawing the machine's moves from its shared boxes. Each game is a
+Game with its own position, and the winner's moves are replenished by
+Game.finish in one step once it is over - nothing awaits in between, so
+no other game sees half of the reinforcement.
+
+Messages are JSON, one per line. The client sends {"start": 1} (machine
+first) or {"start": 2} (human first), then {"move": n} for each move,
+where -1 or 0 resigns. The server replies with
+    {"type": "turn", "state": s, "desc": [...], "legal": [...],
+     "machine": m}
+when it is the human's turn, m being the machine's last move or null, and
+    {"type": "over", "winner": w, "machine": m, "latency": {...}}
+when the game ends - the winner is 1 for the machine and 2 for the human.
+The server times how long it takes to answer each message, and reports
+each connection's latency when it closes.
+
+Example: serve the 2000-game intelligent model, then connect from another
+terminal
+
+    python chompServer.py serve \
+        --load ../stored-games/2000GamesIntelligent.chomp
+    python chompServer.py client
+
+swarm connects many simulated players at once, to check the server keeps
+up with them:
+
+    python chompServer.py swarm --clients 300 --games 10
+
+"""
+import argparse
+import asyncio
+import json
+import time
+import numpy as np
+from chomp import Bar, Game
+
+
+class Latency(object):
+    '''Counts and times the messages a connection has answered'''
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.worst = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.worst = max(self.worst, seconds)
+
+    def summary(self):
+        '''Returns the mean and worst latency in milliseconds'''
+        return {'messages': self.count,
+                'meanMs': 1000*self.total/max(self.count, 1),
+                'worstMs': 1000*self.worst}
+
+
+class Session(object):
+    '''One connection to the server, and the game it is playing'''
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.bar = server.bar
+        self.reader = reader
+        self.writer = writer
+        self.latency = Latency()
+        self.game = None  # no game in progress
+
+    def start(self, whofirst):
+        '''Starts a new game, with the machine moving first if whofirst is
+        1 or the human first if it is 2. Returns the reply'''
+        if whofirst not in [1, 2]:
+            return {'type': 'error', 'message': 'start must be 1 or 2'}
+        self.game = Game(self.bar)
+        self.game.start(whofirst)
+        if whofirst == 1:
+            return self.machineMove()
+        return self.turn(None)
+
+    def humanMove(self, move):
+        '''Makes the human's move and the machine's reply. Returns the
+        reply'''
+        if self.game is None:
+            return {'type': 'error', 'message': 'No game started'}
+        if move in (-1, 0):  # resigns, or eats the poison
+            self.game.apply(-1)
+            return self.finish(None)
+        if move not in self.game.legalMoves():
+            return {'type': 'error', 'message': 'Illegal move'}
+        self.game.apply(move)
+        return self.machineMove()
+
+    def machineMove(self):
+        '''Draws the machine's move from the shared boxes'''
+        game = self.game
+        move = game.machineMove()
+        if not game.finished and not game.legalMoves():
+            game.apply(-1)  # only the poison is left for the human
+        if game.finished:
+            return self.finish(None if move == -1 else move)
+        return self.turn(move)
+
+    def turn(self, machine):
+        '''Returns the message asking the human to move'''
+        game = self.game
+        return {'type': 'turn', 'state': game.state,
+                'desc': game.desc.tolist(), 'legal': game.legalMoves(),
+                'machine': machine}
+
+    def finish(self, machine):
+        '''Replenishes the winner's moves in one step and returns the
+        message ending the game'''
+        winner = self.game.finish()
+        self.game = None
+        self.server.gamesFinished += 1
+        return {'type': 'over', 'winner': winner, 'machine': machine,
+                'latency': self.latency.summary()}
+
+    def handle(self, message):
+        '''Returns the reply to a message from the client'''
+        if 'start' in message:
+            return self.start(int(message['start']))
+        if 'move' in message:
+            return self.humanMove(int(message['move']))
+        return {'type': 'error', 'message': 'Unknown message'}
+
+    async def run(self):
+        '''Answers messages until the client disconnects'''
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                received = time.perf_counter()
+                try:
+                    reply = self.handle(json.loads(line))
+                except (ValueError, TypeError):
+                    reply = {'type': 'error', 'message': 'Bad message'}
+                self.writer.write((json.dumps(reply) + '\n').encode())
+                await self.writer.drain()
+                self.latency.add(time.perf_counter()-received)
+        except ConnectionError:
+            pass
+        finally:
+            self.writer.close()
+        return self.latency
+
+
+class ChompServer(object):
+    '''Serves games of Chomp against bar to any number of connections'''
+
+    def __init__(self, bar, host='127.0.0.1', port=8642):
+        self.bar = bar
+        self.host = host
+        self.port = port
+        self.sessions = 0  # open connections
+        self.gamesFinished = 0
+
+    async def connected(self, reader, writer):
+        self.sessions += 1
+        peer = writer.get_extra_info('peername')
+        latency = await Session(self, reader, writer).run()
+        self.sessions -= 1
+        summary = latency.summary()
+        print('{} left after {} messages: mean {:.3f} ms, worst {:.3f} ms'
+              .format(peer, summary['messages'], summary['meanMs'],
+                      summary['worstMs']))
+
+    async def serve(self):
+        '''Serves until cancelled'''
+        server = await asyncio.start_server(self.connected, self.host,
+                                            self.port)
+        print('Serving Chomp on {}:{}'.format(self.host, self.port))
+        async with server:
+            await server.serve_forever()
+
+
+def showBar(desc, rows, cols):
+    """Prints the squares left in a bar with their numbers"""
+    for i in range(rows):
+        print('|', end='')
+        for j in range(cols):
+            print('{:2}|'.format(j+i*cols) if desc[j] > i else '  |',
+                  end='')
+        print('')
+    print('')
+
+
+def client(host='127.0.0.1', port=8642, rows=3, cols=4):
+    """Plays games against a server from the terminal"""
+    import socket
+    with socket.create_connection((host, port)) as sock:
+        stream = sock.makefile('rw')
+
+        def send(message):
+            start = time.perf_counter()
+            stream.write(json.dumps(message) + '\n')
+            stream.flush()
+            reply = json.loads(stream.readline())
+            return reply, time.perf_counter()-start
+
+        while True:
+            whofirst = input('Who plays first? 1 for Chomp, 2 for Human, '
+                             'blank to quit: ')
+            if whofirst not in ['1', '2']:
+                break
+            reply, _ = send({'start': int(whofirst)})
+            while reply['type'] != 'over':
+                if reply['type'] == 'error':
+                    print(reply['message'])
+                elif reply['machine'] is not None:
+                    print('Machine ate square {}'.format(reply['machine']))
+                if reply['type'] == 'turn':
+                    desc = reply['desc']
+                    showBar(desc, rows, cols)
+                try:
+                    move = int(input('Which square would you like to eat? '
+                                     '(-1 to resign) '))
+                except ValueError:
+                    move = -2  # not a square, so the server refuses it
+                reply, seconds = send({'move': move})
+                print('({:.1f} ms)'.format(1000*seconds))
+            if reply['machine'] is not None:
+                print('Machine ate square {}'.format(reply['machine']))
+            print('THE COMPUTER WINS' if reply['winner'] == 1
+                  else 'YOU WIN - but Chomp learns from its mistakes!')
+
+
+async def simulatedPlayer(host, port, nGames, times):
+    """Plays nGames games with random moves, adding the round trip time of
+    every message to times"""
+    reader, writer = await asyncio.open_connection(host, port)
+
+    async def send(message):
+        start = time.perf_counter()
+        writer.write((json.dumps(message) + '\n').encode())
+        await writer.drain()
+        reply = json.loads(await reader.readline())
+        times.append(time.perf_counter()-start)
+        return reply
+
+    for game in range(nGames):
+        reply = await send({'start': 1 + game % 2})
+        while reply['type'] == 'turn':
+            reply = await send({'move': int(np.random.choice(
+                reply['legal'] or [-1]))})
+    writer.close()
+    await writer.wait_closed()
+
+
+async def swarm(host, port, clients, nGames):
+    """Plays nGames games on each of clients simultaneous connections and
+    prints the round trip times"""
+    times = []
+    start = time.perf_counter()
+    await asyncio.gather(*[simulatedPlayer(host, port, nGames, times)
+                           for _ in range(clients)])
+    elapsed = time.perf_counter()-start
+    times = 1000*np.array(times)
+    print('{} clients played {} games in {:.1f} s: {:.0f} messages/s, '
+          'round trip median {:.2f} ms, 99th percentile {:.2f} ms'.format(
+              clients, clients*nGames, elapsed, len(times)/elapsed,
+              np.median(times), np.percentile(times, 99)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve games of Chomp to many players at once')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serveParser = commands.add_parser('serve', help='run the server')
+    serveParser.add_argument('--load', help='model to start from')
+    serveParser.add_argument('--save', help='model to save on exit')
+    clientParser = commands.add_parser('client', help='play from here')
+    swarmParser = commands.add_parser('swarm',
+                                      help='connect simulated players')
+    swarmParser.add_argument('--clients', type=int, default=100)
+    swarmParser.add_argument('--games', type=int, default=10)
+    for sub in [serveParser, clientParser, swarmParser]:
+        sub.add_argument('--host', default='127.0.0.1')
+        sub.add_argument('--port', type=int, default=8642)
+        sub.add_argument('--rows', type=int, default=3)
+        sub.add_argument('--cols', type=int, default=4)
+    args = parser.parse_args()
+    if args.command == 'serve':
+        bar = Bar(args.rows, args.cols)
+        if args.load:
+            bar.load(args.load)
+        try:
+            asyncio.run(ChompServer(bar, args.host, args.port).serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            bar.record()
+            if args.save:
+                bar.save(args.save)
+    elif args.command == 'client':
+        client(args.host, args.port, args.rows, args.cols)
+    else:
+        asyncio.run(swarm(args.host, args.port, args.clients, args.games))
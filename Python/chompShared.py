@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Trains one chomp machine with several processes at once
+
+Every box is created, the bead counts are copied into a block of shared
+memory, and every worker process plays its share of the games with
+Bar.playBatch directly against that block, so all of them learn into the
+same boxes. By default updates are lock-free: two workers changing the
+same count at the same moment can lose one of the changes, which barely
+matters against thousands of games. With lockStates=True each worker holds
+a lock for every box it changes, chosen from a fixed set of stripes by
+state number.
+
+When the workers finish, the counts are checked - none may be negative and
+illegal moves must hold no beads - and copied back into the bar. If the
+bar has a GameLog, each worker logs its games to a file of its own, and
+these are added to the bar's log one worker after another.
+
+Example: train the default bar with 8 processes
+
+    In: bar = Bar()
+    In: trainShared(bar, 100000, 'intelligent', processes=8)
+
+"""
+import multiprocessing as mp
+import os
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from chomp import Bar, GameLog
+
+
+def worker(bar, shmName, nGames, opponent, batch, seed, locks, results,
+           logFile=None):
+    """Plays nGames games against the shared bead counts and puts the
+    number of games played and won on the results queue, or None if
+    something went wrong. The games are logged to logFile if it is
+    given"""
+    shm = SharedMemory(name=shmName)
+    outcome = None
+    try:
+        store = bar.boxStore
+        store.beads = np.ndarray(store.beads.shape, dtype=store.beads.dtype,
+                                 buffer=shm.buf)
+        bar.beadLocks = locks
+        bar.journal = None  # the parent process records the run
+        bar.gameLog = None  # and adds the workers' logs to its own
+        if logFile is not None:
+            GameLog(bar, logFile)
+        np.random.seed(seed)
+        played = 0
+        won = 0
+        while played < nGames:
+            n = min(batch, nGames-played)
+            won += int(np.sum(bar.playBatch(opponent, n) == 1))
+            played += n
+        outcome = (played, won)
+    finally:
+        if bar.gameLog is not None:
+            bar.gameLog.close()
+        results.put(outcome)
+        bar.boxStore.clear()  # release the shared buffer
+        shm.close()
+
+
+def checkBeads(bar, beads):
+    """Checks that no bead count is negative and illegal moves have no beads,
+    fixing any that are wrong. Returns the number of counts fixed"""
+    negative = beads < 0
+    illegal = (beads != 0) & ~bar.legal
+    bad = int(np.sum(negative | illegal))
+    if bad:
+        print('Fixed {} inconsistent bead counts'.format(bad))
+        beads[negative] = 0
+        beads[illegal] = 0
+    return bad
+
+
+def trainShared(bar, nGames, opponent, processes=None, batch=100,
+                lockStates=False, stripes=64, seed=None):
+    """Trains bar over nGames games of Chomp split between several processes
+    sharing one array of bead counts. Returns the number of games won.
+
+    opponent is 'random' or 'intelligent', as for Bar.playBatch, and each
+    worker plays batch games at a time in lockstep. With lockStates, boxes
+    are locked while they are changed, using stripes locks between them.
+    """
+    if processes is None:
+        processes = os.cpu_count()
+    if seed is None:
+        seed = np.random.randint(2**31-processes)
+    store = bar.boxStore
+    store.materializeAll()  # so every process finds state n in row n
+    logFiles = [None]*processes
+    if bar.gameLog is not None:
+        bar.gameLog.flush()  # so forked workers inherit nothing unwritten
+        logFiles = ['{}.{}.tmp'.format(bar.gameLog.filename, i)
+                    for i in range(processes)]
+        for logFile in logFiles:  # left by a run which failed
+            if os.path.exists(logFile):
+                os.remove(logFile)
+    shm = SharedMemory(create=True, size=store.beads.nbytes)
+    try:
+        shared = np.ndarray(store.beads.shape, dtype=store.beads.dtype,
+                            buffer=shm.buf)
+        shared[:] = store.beads
+        locks = [mp.Lock() for _ in range(stripes)] if lockStates else None
+        results = mp.Queue()
+        shares = np.diff(np.linspace(0, nGames, processes+1).astype(int))
+        workers = [mp.Process(target=worker,
+                              args=(bar, shm.name, int(n), opponent, batch,
+                                    seed+i, locks, results, logFiles[i]))
+                   for i, n in enumerate(shares)]
+        for p in workers:
+            p.start()
+        outcomes = [results.get() for p in workers]  # before join
+        for p in workers:
+            p.join()
+        if None in outcomes:
+            raise RuntimeError('A training worker failed')
+        checkBeads(bar, shared)
+        store.beads[:] = shared
+        for logFile in logFiles:
+            if logFile is not None:
+                bar.gameLog.appendLog(logFile)
+    finally:
+        shared = None  # release the shared buffer
+        shm.close()
+        shm.unlink()
+        for logFile in logFiles:
+            if logFile is not None and os.path.exists(logFile):
+                os.remove(logFile)
+    bar.refreshBeadTree()
+    played, won = np.sum(outcomes, 0)
+    bar.gamesPlayed += int(played)
+    bar.gamesWon += int(won)
+    if bar.journal is not None:
+        bar.journal.gameOver(range(bar.nStates), int(played))
+    return int(won)
+
+
+if __name__ == '__main__':
+    import time
+    b = Bar()
+    for n in [1, 2, 4, os.cpu_count()]:
+        start = time.time()
+        trainShared(b, 200000, 'intelligent', processes=n)
+        print('{} processes: {:.0f} games/s'.format(
+            n, 200000/(time.time()-start)))
+    b.record()
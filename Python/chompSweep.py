@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runs a grid of chomp training settings in parallel and collects the win-rate
+curves into one table
+
+Each point in the grid is a choice of bounty, maxBeads and minBeads. Every
+point is trained from scratch once per seed against the chosen opponent,
+and the win rate is recorded every few games. Runs are spread over a
+process pool, and each finished run is appended to a CSV file, so an
+interrupted sweep picks up where it stopped when started again with the
+same output file.
+
+Example: compare bounties against random opposition, 5 seeds each
+
+    python chompSweep.py --bounty 1 2 3 --maxBeads 2 3 6 --seeds 5 \\
+        --games 2000 --opponent random --out sweep.csv
+
+"""
+import argparse
+import csv
+import os
+from itertools import product
+from multiprocessing import Pool
+import numpy as np
+from chomp import Bar
+
+columns = ['rows', 'cols', 'bounty', 'maxBeads', 'minBeads', 'opponent',
+           'seed', 'nGames', 'every', 'batch', 'games', 'gamesWon',
+           'winRate', 'recentWinRate']
+
+
+def runKey(row):
+    """Returns the settings which identify a single training run"""
+    return (int(row['rows']), int(row['cols']), int(row['bounty']),
+            int(row['maxBeads']), int(row['minBeads']), row['opponent'],
+            int(row['seed']), int(row['nGames']), int(row['every']),
+            int(row['batch']))
+
+
+def trainOne(run):
+    """Trains one bar from scratch and returns its win-rate curve as a
+    list of rows for the results table"""
+    (rows, cols, bounty, maxBeads, minBeads, opponent,
+     seed, nGames, every, batch) = run
+    bar = Bar(rows, cols, bounty, maxBeads, minBeads)
+    curve = bar.train(nGames, opponent, seed, every, batch=batch)
+    return [{'rows': rows, 'cols': cols, 'bounty': bounty,
+             'maxBeads': maxBeads, 'minBeads': minBeads,
+             'opponent': opponent, 'seed': seed, 'nGames': nGames,
+             'every': every, 'batch': batch,
+             'games': int(point['games']), 'gamesWon': int(point['won']),
+             'winRate': float(point['winRate']),
+             'recentWinRate': float(point['recentWinRate'])}
+            for point in curve]
+
+
+def readResults(filename):
+    """Returns the rows of a results CSV file as a list of dictionaries"""
+    if not os.path.exists(filename):
+        return []
+    with open(filename, 'r', newline='') as csvfile:
+        reader = csv.DictReader(csvfile)
+        if reader.fieldnames is not None and reader.fieldnames != columns:
+            raise ValueError('{} was written with different columns - use '
+                             'a new results file'.format(filename))
+        return list(reader)
+
+
+def toArray(results):
+    """Converts rows of results into a numpy structured array"""
+    dtype = [('rows', int), ('cols', int), ('bounty', int),
+             ('maxBeads', int), ('minBeads', int), ('opponent', 'U11'),
+             ('seed', int), ('nGames', int), ('every', int),
+             ('batch', int), ('games', int), ('gamesWon', int),
+             ('winRate', float), ('recentWinRate', float)]
+    return np.array([tuple(row[c] for c in columns) for row in results],
+                    dtype=dtype)
+
+
+def sweep(grid, seeds, nGames, opponent, filename, rows=3, cols=4,
+          every=100, batch=1, processes=None):
+    """Trains a bar for every combination of settings in grid and every
+    seed, and returns the combined results as a structured array
+
+    grid is a dictionary which may hold lists of values for 'bounty',
+    'maxBeads' and 'minBeads' - missing entries take the Bar defaults.
+    seeds is either a number of seeds (0 to seeds-1) or a list of them.
+    batch is how many games are played at once by Bar.playBatch - 1 plays
+    the games one after another with Bar.play.
+
+    Results are appended to the CSV file filename as each run finishes,
+    and runs already in the file with the same settings, number of games,
+    every and batch are skipped. Only the runs asked for are returned.
+    """
+    if isinstance(seeds, int):
+        seeds = range(seeds)
+    bounties = grid.get('bounty', [3])
+    maxBeadList = grid.get('maxBeads', [3])
+    minBeadList = grid.get('minBeads', [1])
+    opponent = opponent.lower()
+
+    wanted = set((rows, cols, bounty, maxBeads, minBeads, opponent, seed,
+                  nGames, every, batch)
+                 for bounty, maxBeads, minBeads, seed in product(
+                     bounties, maxBeadList, minBeadList, seeds))
+    results = [row for row in readResults(filename) if runKey(row) in wanted]
+    done = set(runKey(row) for row in results)
+    todo = sorted(wanted - done)
+    print('{} runs to do, {} already done'.format(len(todo), len(done)))
+
+    newFile = not os.path.exists(filename)
+    with open(filename, 'a', newline='') as csvfile, \
+            Pool(processes) as pool:
+        writer = csv.DictWriter(csvfile, fieldnames=columns)
+        if newFile:
+            writer.writeheader()
+        for i, curve in enumerate(pool.imap_unordered(trainOne, todo)):
+            writer.writerows(curve)
+            csvfile.flush()  # keep finished runs if interrupted
+            results.extend(curve)
+            print('Finished run {} of {}'.format(i+1, len(todo)))
+    return toArray(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Sweep chomp training settings in parallel')
+    parser.add_argument('--bounty', type=int, nargs='+', default=[3])
+    parser.add_argument('--maxBeads', type=int, nargs='+', default=[3])
+    parser.add_argument('--minBeads', type=int, nargs='+', default=[1])
+    parser.add_argument('--seeds', type=int, default=5,
+                        help='number of seeds per setting')
+    parser.add_argument('--games', type=int, default=2000,
+                        help='games to train for in each run')
+    parser.add_argument('--opponent', default='random',
+                        choices=['random', 'intelligent'])
+    parser.add_argument('--rows', type=int, default=3)
+    parser.add_argument('--cols', type=int, default=4)
+    parser.add_argument('--every', type=int, default=100,
+                        help='games between win-rate records')
+    parser.add_argument('--batch', type=int, default=1,
+                        help='games played at once in lockstep')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes (default: all cores)')
+    parser.add_argument('--out', default='sweep.csv',
+                        help='results file, resumed if it exists')
+    args = parser.parse_args()
+    sweep({'bounty': args.bounty, 'maxBeads': args.maxBeads,
+           'minBeads': args.minBeads},
+          args.seeds, args.games, args.opponent, args.out,
+          rows=args.rows, cols=args.cols, every=args.every,
+          batch=args.batch, processes=args.processes)
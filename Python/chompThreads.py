@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Plays games from many threads at once against one set of boxes, and checks
+that no beads go missing
+
+After Bar.shareBetweenThreads, every box lives in one array and is guarded
+by one of a fixed number of locks (lock striping), so threads touching
+different boxes rarely wait for each other. Box.draw and Box.replenish
+hold the lock of their box, and Game.finish holds bar.recordLock while it
+counts the game.
+
+stressCheck runs threads which each play their own Game, keeping a tally
+of every bead they take out or put in, with Python's thread switch interval
+turned right down so the threads interleave as much as possible. When they
+finish, the beads in the boxes must equal the starting total plus the
+tallies, no count may be negative, every Fenwick tree must match its box,
+and every game must have been counted. With locked=False the same run
+shows what happens without the locks.
+
+Example: 8 threads sharing 4 locks
+
+    python chompThreads.py --threads 8 --stripes 4
+
+"""
+import argparse
+import sys
+import threading
+import numpy as np
+from chomp import Bar, Game
+
+
+def playSession(bar, nGames, opponent, tally, index):
+    """Plays nGames games against opponent, putting the change it made to
+    the number of beads in the boxes in tally[index], or the error which
+    stopped it"""
+    try:
+        tally[index] = playGames(bar, nGames, opponent)
+    except Exception as error:  # a race corrupted the boxes
+        tally[index] = error
+
+
+def playGames(bar, nGames, opponent):
+    """Plays nGames games against opponent, and returns the change they
+    made to the number of beads in the boxes"""
+    startTotals = bar.startingBeads(np.arange(bar.nStates)).sum(1)
+    game = Game(bar, opponent)
+    change = 0
+    for i in range(nGames):
+        game.start(1 + i % 2)
+        while not game.finished:
+            if game.player == 1 or opponent == 'intelligent':
+                state = game.state
+                move = game.drawMove()
+                if move == -1:  # the box was empty, and has been refilled
+                    change += int(startTotals[state])
+                else:
+                    change -= 1
+            else:
+                move = game.randomMove()
+            game.apply(move)
+        if game.finish() == 1:
+            change += bar.bounty*len(game.pcMoveList)
+        else:
+            change += bar.bounty*len(game.opponentMoveList)
+    return change
+
+
+def stressCheck(threads=8, nGames=2000, stripes=4, opponent='intelligent',
+                locked=True, rows=3, cols=4):
+    """Plays nGames games on each of threads threads sharing one bar, and
+    returns True if every bead is accounted for"""
+    bar = Bar(rows, cols)
+    if locked:
+        bar.shareBetweenThreads(stripes)
+    else:
+        bar.boxStore.materializeAll()
+    store = bar.boxStore
+    before = int(store.beads.sum())
+    tally = [0]*threads
+    workers = [threading.Thread(target=playSession,
+                                args=(bar, nGames, opponent, tally, i))
+               for i in range(threads)]
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # switch threads as often as possible
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        sys.setswitchinterval(interval)
+
+    problems = []
+    errors = [error for error in tally if isinstance(error, Exception)]
+    if errors:
+        problems.append('{} threads failed ({})'.format(
+            len(errors), repr(errors[0])))
+    after = int(store.beads.sum())
+    expected = before + sum(change for change in tally
+                            if not isinstance(change, Exception))
+    if after != expected:
+        problems.append('{} beads, expected {}'.format(after, expected))
+    if np.any(store.beads < 0):
+        problems.append('{} negative counts'.format(
+            int(np.sum(store.beads < 0))))
+    if not np.array_equal(store.tree, bar.produceBeadTree(store.beads)):
+        problems.append('Fenwick trees out of step with the beads')
+    if bar.gamesPlayed != threads*nGames:
+        problems.append('{} games counted, {} played'.format(
+            bar.gamesPlayed, threads*nGames))
+    print('{} threads, {} games each, {}: {}'.format(
+        threads, nGames,
+        '{} locks'.format(stripes) if locked else 'no locks',
+        '; '.join(problems) or 'every bead accounted for'))
+    return not problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check that threads sharing boxes lose no beads')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--games', type=int, default=2000,
+                        help='games played by each thread')
+    parser.add_argument('--stripes', type=int, default=4,
+                        help='locks shared between the boxes')
+    parser.add_argument('--opponent', default='intelligent',
+                        choices=['random', 'intelligent'])
+    parser.add_argument('--unlocked', action='store_true',
+                        help='also run without locks, for comparison')
+    args = parser.parse_args()
+    ok = stressCheck(args.threads, args.games, args.stripes, args.opponent)
+    if args.unlocked:
+        stressCheck(args.threads, args.games, args.stripes, args.opponent,
+                    locked=False)
+    sys.exit(0 if ok else 1)